@@ -143,7 +143,7 @@ class SMProcessingDialog(QtWidgets.QDialog, FORM_CLASS):
             # Clear previous contents to ensure no duplicates
             self.DEM_ComboBox.clear()
             # self.AdditionalRaster_ComboBox.clear()
-            # self.ElevationZone_ComboBox.clear()
+            self.DEM_ComboBox_2.clear()
 
             vectors = []
             rasters = []
@@ -161,7 +161,7 @@ class SMProcessingDialog(QtWidgets.QDialog, FORM_CLASS):
             # self.AdditionalRaster_ComboBox.addItems(rasters)
 
             # Add the vectors to comboboxes accepting vectors
-            # self.ElevationZone_ComboBox.addItems(vectors)
+            self.DEM_ComboBox_2.addItems(vectors)
 
             # Define DEM
             if self.DEM_ComboBox.currentText() is not None:
@@ -226,12 +226,41 @@ class SMProcessingDialog(QtWidgets.QDialog, FORM_CLASS):
         self.log_message(f"Classify Results:")
         self.log_message(f"Classifying Finished, and saved at: {save_path}")
         self.log_message(result)
-        self.load_raster(save_path, "Classify Result")
+        layer = self.load_raster(save_path, "Classify Result")
+        if layer is not None:
+            QgsProject.instance().addMapLayer(layer)
 
     def on_intersect(self):
-        """Zonal Intersection between elevation zones and DEM
+        """Zonal Intersection between elevation zones and DEM: elevation
+           statistics and hypsometry of every zonal polygon, saved as
+           'zonal_stats.csv' in the directory containing the DEM
         """
-        pass  # Todo add code
+        self.SEPARATOR()
+        if self.DEM is None:
+            self.log_message("ERROR: DEM file not chosen.")
+            return
+        zones_name = self.DEM_ComboBox_2.currentText()
+        if not zones_name:
+            self.log_message("ERROR: Zonal polygons not chosen.")
+            return
+
+        # Sources of layers within a file are of the form
+        #   `path|layername=name`
+        source = self.getLayerObj(zones_name).source().split('|')
+        layer_name = None
+        for option in source[1:]:
+            key, _, value = option.partition('=')
+            if key == 'layername':
+                layer_name = value
+
+        table, hypsometry = self.DEM.zonal_stats(source[0], layer_name)
+        save_path = os.path.join(self.DEM.working_directory,
+                                 "zonal_stats.csv")
+        table.join(hypsometry).to_csv(save_path)
+
+        self.log_message("Zonal Statistics:")
+        self.log_message(table)
+        self.log_message(f"Zonal statistics saved at: {save_path}")
 
     def on_export_uniques(self):
         """Export unique values
@@ -446,7 +475,7 @@ class SMProcessingDialog(QtWidgets.QDialog, FORM_CLASS):
             self.aqua_file_paths,
             working_directory_path
         )
-        Snow_processor.step_2()
+        Snow_processor.step_2(self.previous_step_outputs(Snow_processor, 1))
 
     def on_step3(self):
         working_directory_path = self.Snow_OutputDirectoryLineEdit.text()
@@ -457,7 +486,27 @@ class SMProcessingDialog(QtWidgets.QDialog, FORM_CLASS):
             working_directory_path,
             self.DEM_path
         )
-        Snow_processor.step_3()
+        Snow_processor.step_3(self.previous_step_outputs(Snow_processor, 2))
+
+    def previous_step_outputs(self, Snow_processor, step):
+        """Inputs of the step after `step`. With Terra and Aqua files
+        loaded, returns None, so that the earlier steps are chained through
+        the manifest and only the outputs of changed inputs are made again.
+        Otherwise the existing outputs of `step` in the working directory are
+        reused as they are, or None is returned if there are none.
+
+        Args:
+            Snow_processor: SnowProcessing object of the current run
+            step: Number of the step whose outputs are looked for
+        """
+        if self.terra_file_paths and self.aqua_file_paths:
+            return None
+        directory = Snow_processor.step_directory(step)
+        if directory is not None:
+            self.log_message(f"Reusing Step-{step} outputs in: {directory}. "
+                             f"Load the Terra and Aqua files to update them "
+                             f"instead.")
+        return directory
 
     def log_message(self, text):
         """Pass on messages passed as `text` to the OutputPane
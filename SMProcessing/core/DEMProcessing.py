@@ -1,13 +1,428 @@
-from qgis import processing
 import os
+import math
 import numpy as np
-from osgeo import gdal
+import pandas as pd
+from osgeo import gdal, gdal_array, ogr, osr
 import numpy.ma as ma
 
+from .SnowProcessing import Raster, RasterWriter, _stream_block_size
+
+# Methods of computing the class breaks, see `DEMProcessing.breaks`
+CLASSIFICATION_METHODS = ('equal', 'quantile', 'equal_area', 'jenks')
+
+# Integer DEMs spanning at most this many values are classified through a
+# lookup table, instead of a binary search of the breaks for every pixel
+_MAX_LOOKUP_TABLE_SIZE = 2**20
+
+
+def _valid_mask(block, nodata=None):
+    """Boolean mask of the pixels of `block` which are neither `nodata` nor
+    NaN
+    """
+    valid = np.ones(block.shape, dtype=bool)
+    if np.issubdtype(block.dtype, np.floating):
+        valid &= ~np.isnan(block)
+    if nodata is not None and not math.isnan(nodata):
+        valid &= block != nodata
+    return valid
+
+
+def _valid_values(block, nodata=None):
+    """The values of `block` which are neither `nodata` nor NaN, flattened"""
+    return block[_valid_mask(block, nodata)]
+
+
+def _stream_stats(blocks, nodata=None):
+    """Statistics of the valid values of `blocks`, in a single pass.
+
+    The count, mean and sum of squared deviations of every block are merged
+    into the running ones (Welford's update, generalised to blocks by Chan
+    et al.), which does not lose precision the way summing squares does.
+
+    Args:
+        blocks: Iterable of (window, array), as returned by `Raster.blocks`
+        nodata: No-data value of the raster, or None
+    Returns:
+        stats {Dict}: The keys of `qgis:rasterlayerstatistics` (MIN, MAX,
+                      RANGE, SUM, MEAN, STD_DEV, SUM_OF_SQUARES) and COUNT,
+                      the number of valid pixels
+    """
+    count = 0
+    mean = 0.0
+    m2 = 0.0
+    total = 0.0
+    minimum, maximum = math.inf, -math.inf
+
+    for _, block in blocks:
+        values = _valid_values(block, nodata).astype(np.float64, copy=False)
+        n = values.size
+        if n == 0:
+            continue
+
+        block_mean = values.mean()
+        block_m2 = np.square(values - block_mean).sum()
+
+        delta = block_mean - mean
+        merged = count + n
+        mean += delta * n / merged
+        m2 += block_m2 + delta ** 2 * count * n / merged
+        count = merged
+
+        total += values.sum()
+        minimum = min(minimum, values.min())
+        maximum = max(maximum, values.max())
+
+    if count == 0:
+        minimum = maximum = mean = math.nan
+    std_dev = math.sqrt(m2 / count) if count else math.nan
+
+    return {
+        'MIN': float(minimum),
+        'MAX': float(maximum),
+        'RANGE': float(maximum - minimum),
+        'SUM': float(total),
+        'MEAN': float(mean),
+        'STD_DEV': std_dev,
+        # Sum of squared deviations from the mean, as QGIS reports it
+        'SUM_OF_SQUARES': float(m2),
+        'COUNT': count,
+    }
+
+
+def _block_counts(values):
+    """(unique values, counts) of the 1D array `values`. Integer values
+    spanning a small range are counted with `bincount`, without sorting.
+    """
+    if values.size and np.issubdtype(values.dtype, np.integer):
+        low, high = int(values.min()), int(values.max())
+        if high - low <= 4 * values.size:
+            # Cast before shifting, which could overflow the input dtype
+            counts = np.bincount(values.astype(np.intp) - low,
+                                 minlength=high - low + 1)
+            present = np.flatnonzero(counts)
+            return present + low, counts[present]
+    return np.unique(values, return_counts=True)
+
+
+def _stream_uniques(blocks, nodata=None, decimals=None):
+    """Count the unique valid values of `blocks`, merging the counts of every
+    block, so that only one block and the table of counts are held in memory.
+
+    Args:
+        blocks: Iterable of (window, array), as returned by `Raster.blocks`
+        nodata: No-data value of the raster, or None
+        decimals: If given, values are rounded to this many decimals before
+                  being counted, which bounds the table of float DEMs
+    Returns:
+        (values, counts, nodata_count): Sorted unique values, the number of
+                                        pixels of each, and the number of
+                                        no-data pixels
+    """
+    values = np.empty(0)
+    counts = np.empty(0, dtype=np.int64)
+    nodata_count = 0
+
+    for _, block in blocks:
+        block_values = _valid_values(block, nodata)
+        nodata_count += block.size - block_values.size
+        if decimals is not None:
+            block_values = np.round(block_values, decimals)
+        block_values, block_counts = _block_counts(block_values)
+
+        if values.size == 0:
+            values, counts = block_values, block_counts
+            continue
+        # Merge the block table into the running one
+        values, inverse = np.unique(
+            np.concatenate([values, block_values]), return_inverse=True)
+        counts = np.bincount(
+            inverse,
+            weights=np.concatenate([counts, block_counts]),
+            minlength=values.size).astype(np.int64)
+
+    return values, counts, nodata_count
+
+
+def _histogram_edges(low, high, bins, integer=False):
+    """Edges of `bins` equal bins from `low` to `high`. Integer DEMs spanning
+    fewer values get one bin per value, so that their histogram is exact.
+    """
+    if integer and high - low < bins:
+        return np.arange(low, high + 2, dtype=np.float64)
+    if high == low:
+        return np.array([low, low + 1], dtype=np.float64)
+    return np.linspace(low, high, bins + 1)
+
+
+def _stream_histogram(blocks, edges, nodata=None, row_weights=None):
+    """Histogram of the valid values of `blocks` over the bins `edges`.
+
+    Args:
+        blocks: Iterable of (window, array), as returned by `Raster.blocks`
+        edges: Increasing bin edges; values outside fall in the end bins
+        nodata: No-data value of the raster, or None
+        row_weights: Weight of the pixels of every row of the raster, e.g.
+                     their area. If None, every pixel counts as 1.
+    Returns:
+        counts {numpy array}: (Weighted) number of pixels in every bin
+    """
+    bins = len(edges) - 1
+    counts = np.zeros(bins)
+    for (xoff, yoff, xsize, ysize), block in blocks:
+        valid = _valid_mask(block, nodata)
+        index = np.searchsorted(edges, block[valid], side='right') - 1
+        np.clip(index, 0, bins - 1, out=index)
+
+        weights = None
+        if row_weights is not None:
+            weights = np.broadcast_to(
+                row_weights[yoff:yoff+ysize, np.newaxis], block.shape)[valid]
+        counts += np.bincount(index, weights, minlength=bins)
+    return counts
+
+
+def _quantile_breaks(edges, counts, intervals):
+    """`intervals` boundaries splitting the histogram into classes of equal
+    counts, interpolated linearly within the bins.
+    """
+    cumulative = np.concatenate([[0], np.cumsum(counts)])
+    targets = np.linspace(0, cumulative[-1], intervals)
+    # Empty bins make `cumulative` flat; the first edge reaching each target
+    #   is taken
+    index = np.searchsorted(cumulative, targets, side='left')
+    index = np.clip(index, 1, len(counts))
+    below, above = cumulative[index - 1], cumulative[index]
+    fraction = np.divide(targets - below, above - below,
+                         out=np.zeros_like(targets), where=above > below)
+    breaks = edges[index - 1] + fraction * (edges[index] - edges[index - 1])
+    return np.maximum.accumulate(breaks)
+
+
+def _coarsen_histogram(edges, counts, max_bins):
+    """Merge runs of adjacent bins, so that at most `max_bins` are left"""
+    factor = math.ceil(len(counts) / max_bins)
+    if factor <= 1:
+        return edges, counts
+    padded = np.zeros(math.ceil(len(counts) / factor) * factor)
+    padded[:len(counts)] = counts
+    return np.append(edges[:-1:factor], edges[-1]), \
+        padded.reshape(-1, factor).sum(axis=1)
+
+
+def _jenks_breaks(edges, counts, intervals, max_bins=1024, chunk=64):
+    """Jenks natural breaks of the histogram: the boundaries of the
+    `intervals - 1` classes of bins minimising the sum of the squared
+    deviations from the class means (Fisher's exact algorithm).
+
+    Runs in O(classes * bins^2) on the non-empty bins, independently of the
+    number of pixels, vectorised over `chunk` bins at a time. Histograms of
+    more than `max_bins` bins are coarsened first.
+    """
+    edges, counts = _coarsen_histogram(edges, counts, max_bins)
+    classes = intervals - 1
+    present = np.flatnonzero(counts)
+    weights = counts[present]
+    centres = (edges[present] + edges[present + 1]) / 2
+    lower_edges = edges[present]
+    n = len(present)
+    if n <= classes:
+        return np.concatenate([lower_edges, [edges[-1]]])
+
+    # Prefix sums, so that the deviation of any run of bins is O(1)
+    w = np.concatenate([[0], np.cumsum(weights)])
+    s = np.concatenate([[0], np.cumsum(weights * centres)])
+    q = np.concatenate([[0], np.cumsum(weights * centres ** 2)])
+
+    def deviation(starts, stops):
+        """Squared deviation of the bins [start, stop)"""
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return q[stops] - q[starts] \
+                - (s[stops] - s[starts]) ** 2 / (w[stops] - w[starts])
+
+    # cost[j, i]: least deviation of the first i bins in j+1 classes
+    cost = np.full((classes, n + 1), np.inf)
+    start = np.zeros((classes, n + 1), dtype=np.intp)
+    cost[0, 1:] = deviation(0, np.arange(1, n + 1))
+    for j in range(1, classes):
+        # The last class holds the bins [m, i). Rows of `chunk` values of i
+        #   are solved at once, for every m from j to i-1.
+        for first in range(j + 1, n + 1, chunk):
+            stops = np.arange(first, min(first + chunk, n + 1))[:, np.newaxis]
+            m = np.arange(j, stops[-1, 0])[np.newaxis, :]
+            candidates = np.where(m < stops,
+                                  cost[j - 1, m] + deviation(m, stops),
+                                  np.inf)
+            best = np.argmin(candidates, axis=1)
+            cost[j, stops[:, 0]] = candidates[np.arange(len(best)), best]
+            start[j, stops[:, 0]] = m[0, best]
+
+    # Walk back the starts of the classes
+    bounds = []
+    i = n
+    for j in range(classes - 1, 0, -1):
+        i = start[j, i]
+        bounds.append(lower_edges[i])
+    return np.concatenate([[lower_edges[0]], bounds[::-1], [edges[-1]]])
+
+
+class Classifier:
+    """Maps elevations to the classes between `breaks`.
+
+    Class `i` holds the elevations from `breaks[i]` (included) to
+    `breaks[i+1]` (excluded); the last class also holds `breaks[-1]`. Values
+    outside of the breaks fall in the first or last class. No-data pixels
+    are given `self.nodata`.
+    """
+    def __init__(self, breaks, nodata=None, low=None, high=None):
+        """
+        Args:
+            breaks: Increasing class boundaries, including the minimum and
+                    maximum
+            nodata: No-data value of the DEM, or None
+            low, high: Range of the values of an integer DEM. If it is small
+                       enough, a lookup table of the class of every value is
+                       used instead of searching the breaks.
+        """
+        self.breaks = np.asarray(breaks, dtype=np.float64)
+        self.classes = len(self.breaks) - 1
+        if self.classes < 1:
+            raise ValueError("At least two breaks are needed")
+        if np.any(np.diff(self.breaks) < 0):
+            raise ValueError(f"Breaks are not increasing: {breaks}")
+
+        self.dtype = np.uint8 if self.classes < 255 else np.uint16
+        self.nodata = np.iinfo(self.dtype).max
+        self._dem_nodata = nodata
+
+        self._lut = None
+        if low is not None and high is not None \
+                and high - low < _MAX_LOOKUP_TABLE_SIZE:
+            self._low = int(low)
+            self._lut = self._digitize(np.arange(int(low), int(high) + 1))
+
+    def _digitize(self, values):
+        return np.digitize(values, self.breaks[1:-1]).astype(self.dtype)
+
+    def __call__(self, block):
+        """Classify the 2D array `block`"""
+        valid = _valid_mask(block, self._dem_nodata)
+        if self._lut is not None \
+                and np.issubdtype(block.dtype, np.integer):
+            index = block.astype(np.intp) - self._low
+            # No-data pixels may fall outside of the table
+            np.clip(index, 0, len(self._lut) - 1, out=index)
+            classes = self._lut[index]
+        else:
+            classes = self._digitize(block)
+        classes[~valid] = self.nodata
+        return classes
+
+
+def _grow(array, size, fill=0):
+    """`array`, extended along its first axis to `size` with `fill`"""
+    if len(array) >= size:
+        return array
+    grown = np.full((size,) + array.shape[1:], fill, dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+
+def _stream_zonal_stats(blocks, zone_blocks, nodata=None, classifier=None,
+                        row_areas=None, shift=0.0):
+    """Per-zone statistics of the DEM `blocks`, from the matching blocks of
+    a raster of zone indices. Every statistic of every zone is accumulated by
+    a single `bincount` over the block, whatever the number of zones.
+
+    Args:
+        blocks: Iterable of (window, array) of the DEM
+        zone_blocks: Iterable of the zone index arrays of the same windows.
+                     The statistics are sized by the largest index, so the
+                     indices should be dense, as made by
+                     `DEMProcessing.zone_layer`. Negative indices are outside
+                     of every zone.
+        nodata: No-data value of the DEM, or None
+        classifier: `Classifier` of the elevation bands of the hypsometry,
+                    or None
+        row_areas: Area of the pixels of every row of the DEM. If None,
+                   every pixel has an area of 1.
+        shift: Subtracted from the elevations before summing their squares,
+               e.g. the mean of the DEM, to keep the variances precise
+    Returns:
+        (zones, stats, hypsometry): Indices of the zones holding valid
+                                    pixels, their stats {Dict} (count,
+                                    area, mean, std, min, max) and the area
+                                    of every elevation band in every zone
+    """
+    bands = classifier.classes if classifier is not None else 0
+    count = np.zeros(0)
+    area = np.zeros(0)
+    total = np.zeros(0)
+    squares = np.zeros(0)
+    minimum = np.zeros(0)
+    maximum = np.zeros(0)
+    hypsometry = np.zeros((0, bands))
+
+    for ((xoff, yoff, xsize, ysize), block), zone_block \
+            in zip(blocks, zone_blocks):
+        valid = _valid_mask(block, nodata) & (zone_block >= 0)
+        ids = zone_block[valid].astype(np.intp)
+        if ids.size == 0:
+            continue
+        values = block[valid].astype(np.float64) - shift
+        if row_areas is None:
+            areas = np.ones(ids.size)
+        else:
+            areas = np.broadcast_to(
+                row_areas[yoff:yoff+ysize, np.newaxis], block.shape)[valid]
+
+        zones = ids.max() + 1
+        count = _grow(count, zones)
+        area = _grow(area, zones)
+        total = _grow(total, zones)
+        squares = _grow(squares, zones)
+        minimum = _grow(minimum, zones, np.inf)
+        maximum = _grow(maximum, zones, -np.inf)
+        hypsometry = _grow(hypsometry, zones)
+        zones = len(count)
+
+        count += np.bincount(ids, minlength=zones)
+        area += np.bincount(ids, areas, minlength=zones)
+        total += np.bincount(ids, values, minlength=zones)
+        squares += np.bincount(ids, values ** 2, minlength=zones)
+        np.minimum.at(minimum, ids, values)
+        np.maximum.at(maximum, ids, values)
+        if bands:
+            band = classifier(block)[valid].astype(np.intp)
+            hypsometry += np.bincount(
+                ids * bands + band, areas,
+                minlength=zones * bands).reshape(zones, bands)
+
+    zones = np.flatnonzero(count)
+    count = count[zones]
+    mean = total[zones] / count
+    std = np.sqrt(np.maximum(squares[zones] / count - mean ** 2, 0))
+    stats = {
+        'count': count.astype(np.int64),
+        'area': area[zones],
+        'mean': mean + shift,
+        'std': std,
+        'min': minimum[zones] + shift,
+        'max': maximum[zones] + shift,
+    }
+    return zones, stats, hypsometry[zones]
+
+
 class DEMProcessing:
     """
     Logic Behind DEM Processing
     """
+    # Statistics of the DEMs, keyed by their path and modification time.
+    #   Shared by the instances, as the dialog makes a new one whenever the
+    #   DEM layer is selected again.
+    _stats_cache = dict()
+    _uniques_cache = dict()
+    _histogram_cache = dict()
+
     def __init__(self, raster):
         """
         Args:
@@ -30,127 +445,377 @@ class DEMProcessing:
         print(self.working_directory)
         # self.band = rast_to_arr(self.raster)
 
+    def _cache_key(self):
+        return os.path.abspath(self.path), os.stat(self.path).st_mtime_ns
+
+    def blocks(self):
+        """Iterate over the DEM in large windows, see `Raster.blocks`"""
+        dem = Raster(self.path, lazy=True)
+        return dem.blocks(_stream_block_size(dem.profile))
+
     def calc_stats(self):
         """
-        Calculate and return basic statistics about the DEM raster.
-            Algorithm: `qgis:rasterlayerstatistics`
+        Calculate and return basic statistics about the DEM raster, skipping
+        the no-data pixels. The DEM is streamed block by block, in a single
+        pass, and the result is cached until the DEM file changes.
+
         Returns:
             result {Dict}: {
-                                'Mean': Mean,
-                                'Max': Max,
-                                'Min': Min,
-                                'Std_dev': Standard Deviation,
+                                'MEAN': Mean,
+                                'MAX': Max,
+                                'MIN': Min,
+                                'STD_DEV': Standard Deviation,
+                                'COUNT': Number of valid pixels,
                                 ...
                             }
+                            The keys of `qgis:rasterlayerstatistics`, see
+                            `_stream_stats`.
         """
-        alg_string = "qgis:rasterlayerstatistics"
-        # Prepare Parameters
-        params = {
-            "INPUT": self.raster,
-            "BAND": 1  # 1 for now.
-        }  # TODO Add functionality to choose band
+        # TODO Add functionality to choose band
+        key = self._cache_key()
+        if key not in self._stats_cache:
+            self._stats_cache[key] = _stream_stats(self.blocks(), self.nodata)
+
+        return dict(self._stats_cache[key])
 
-        result = processing.run(alg_string, params)
+    def _unique_table(self, decimals=None):
+        """(table, number of no-data pixels), see `unique_values`"""
+        key = self._cache_key() + (decimals,)
+        if key not in self._uniques_cache:
+            values, counts, nodata_count = _stream_uniques(
+                self.blocks(), self.nodata, decimals)
 
-        return result
+            geotransform = self.gdalRast.GetGeoTransform()
+            pixel_area = abs(geotransform[1] * geotransform[5])
+            table = pd.DataFrame({
+                'value': values,
+                'count': counts,
+                'area': counts * pixel_area,
+            })
+            self._uniques_cache[key] = table, nodata_count
 
-    def export_uniques(self):
+        return self._uniques_cache[key]
+
+    def unique_values(self, decimals=None):
         """
-        Return the unique values in a raster using QGIS native processing
-        algorithm.
+        Count the pixels of every unique value of the DEM, skipping the
+        no-data pixels. The DEM is streamed block by block, and the table is
+        cached until the DEM file changes.
 
-        Algorithm: native:rasterlayeruniquevaluesreport
-        ----Inputs: INPUT:              Input raster layer
-                    BAND:               Raster Band
-                    OUTPUT_HTML_FILE:   (optional) Defaults to temporary file
-                    OUTPUT_TABLE:       (optional) Defaults to skip
+        Args:
+            decimals: Round the values to this many decimals before counting
+                      them. Useful for float DEMs, whose values are otherwise
+                      nearly all unique.
+        Returns:
+            table {pd.DataFrame}: Columns `value`, `count` and `area` (in
+                                  squared map units), sorted by value
+        """
+        table, _ = self._unique_table(decimals)
+        return table.copy()
+
+    def export_uniques(self, path=None, decimals=None):
+        """
+        Write the unique values of the DEM and their pixel counts to a table,
+        see `unique_values`.
+
+        Args:
+            path: Path of the table. Written as Parquet if it ends with
+                  `.parquet`, else as CSV. Defaults to `uniques.csv` in the
+                  directory of the DEM.
+            decimals: See `unique_values`
         Returns:
         ----Result {Dict}:
             {
                 'CRS_AUTHID': CRS as string,
-                'EXTENT': Extent,
                 'HEIGHT_IN_PIXELS': Height in Pix,
                 'NODATA_PIXEL_COUNT': No Data Count,
-                'OUTPUT_HTML_FILE': Path to HTML file with results,
+                'OUTPUT_TABLE': Path to the table,
                 'TOTAL_PIXEL_COUNT': Total Pixels,
-                'WIDTH_IN_PIXELS': 1891
+                'UNIQUE_VALUE_COUNT': Number of unique values,
+                'WIDTH_IN_PIXELS': Width in Pix
             }
         """
-        alg_string = "native:rasterlayeruniquevaluesreport"
-        params = {
-            "INPUT": self.raster,
-            "BAND": 1,  # TODO add functionality to choose band
-            "OUTPUT_TABLE": os.path.join(self.working_directory, "uniques.csv")
+        if path is None:
+            path = os.path.join(self.working_directory, "uniques.csv")
+
+        table, nodata_count = self._unique_table(decimals)
+
+        if path.endswith('.parquet'):
+            table.to_parquet(path, index=False)
+        else:
+            table.to_csv(path, index=False)
+
+        cols, rows = self.gdalRast.RasterXSize, self.gdalRast.RasterYSize
+        return {
+            'CRS_AUTHID': self.crs,
+            'HEIGHT_IN_PIXELS': rows,
+            'NODATA_PIXEL_COUNT': nodata_count,
+            'OUTPUT_TABLE': path,
+            'TOTAL_PIXEL_COUNT': rows * cols,
+            'UNIQUE_VALUE_COUNT': len(table),
+            'WIDTH_IN_PIXELS': cols,
         }
-        result = processing.run(alg_string, params)
-        return result
 
-    def classify(self):
+    def _row_areas(self):
+        """Area in square metres of the pixels of every row, for DEMs in
+        geographic coordinates, whose pixels shrink towards the poles. The
+        ellipsoid is approximated by a sphere of its semi-major axis. None for
+        projected DEMs, whose pixels all have the same area.
         """
-        Will use the algorithm provided by GRASS: grass7:r.reclass
-        TODO Add a check while starting the plugin to see if QGIS has been
-             loaded with GRASS or not. If yes, then classify will run, or it
-             will show a warning.
+        srs = osr.SpatialReference(wkt=self.gdalRast.GetProjectionRef())
+        if not srs.IsGeographic():
+            return None
 
-        Resource: https://grass.osgeo.org/grass78/manuals/r.reclass.html
+        x0, dx, _, y0, _, dy = self.gdalRast.GetGeoTransform()
+        latitudes = y0 + dy * (np.arange(self.gdalRast.RasterYSize) + 0.5)
+        square_degree = (srs.GetSemiMajor() * math.pi / 180) ** 2
+        return (square_degree * np.abs(dx * dy)
+                * np.cos(np.radians(latitudes)))
 
-        The main part of this algorithm is definition of rules. Rules are
-        defined using `txtrules` which will be a string containing rules.
+    def histogram(self, bins=4096, area_weighted=False):
+        """
+        Fine-grained histogram of the DEM, from its minimum to its maximum,
+        streamed block by block. It is cached until the DEM file changes, so
+        that breaks can be recomputed from it in O(bins).
 
-        Rules:
-            old_value_1 old_value_2              = new_value label # Individual
-            old_value_4 thru old_value_5         = new_value label # Range
+        Args:
+            bins: Number of bins. Integer DEMs spanning fewer values get one
+                  bin per value.
+            area_weighted: If True, pixels are counted by their area, which
+                           differs from row to row in geographic coordinates
+        Returns:
+            (edges, counts) {numpy arrays}: Bin edges and (weighted) counts
+        """
+        key = self._cache_key() + (bins, area_weighted)
+        if key not in self._histogram_cache:
+            stats = self.calc_stats()
+            integer = np.issubdtype(
+                gdal_array.GDALTypeCodeToNumericTypeCode(
+                    self.gdalBand.DataType), np.integer)
+            edges = _histogram_edges(stats['MIN'], stats['MAX'], bins,
+                                     integer)
+            row_weights = self._row_areas() if area_weighted else None
+            counts = _stream_histogram(self.blocks(), edges, self.nodata,
+                                       row_weights)
+            self._histogram_cache[key] = edges, counts
 
-        The new lines must be added explicitly in the string
+        edges, counts = self._histogram_cache[key]
+        return edges.copy(), counts.copy()
 
-        Example:
-            -------------------------
-            *            = NULL
-            100 25 10    = 1 Snow
-            150 thru 250 = 2 Non Snow
-            -------------------------
-            Will mark the pixels of value 100, 25 and 10 as 1 and label as snow
-            and the pixels with value in between 150 and 250 will be
-            represented by the value 2 and label as Non Snow.
+    def breaks(self, method='equal', intervals=10, bins=4096):
+        """
+        Class boundaries of the DEM, from its minimum to its maximum. Except
+        for 'equal', they are computed from the cached `histogram`, without
+        reading the DEM again.
 
-        Algorithm: grass7:r.reclass
-        ----Inputs: input               Input Raster Layer
-                    txtrules            String containing rules
-                    output              Path of output. Either Memory or Disk
+        Args:
+            method: One of `CLASSIFICATION_METHODS`:
+                    'equal': intervals of equal elevation
+                    'quantile': classes of equal pixel counts
+                    'equal_area': classes of equal area; the same as
+                                  'quantile' unless the DEM is in geographic
+                                  coordinates
+                    'jenks': Jenks natural breaks, minimising the variance
+                             of the elevations within the classes
+            intervals: Number of boundaries, i.e. one more than the number
+                       of classes
+            bins: Number of bins of the histogram
         Returns:
-        ---- (Dict)
-        {
-            'output': QgsProcessingOutputLayerDefinition  # path to output is
-                                                            stored as `sink`
-        }
+            breaks {numpy array}: Increasing boundaries
         """
+        if method not in CLASSIFICATION_METHODS:
+            raise ValueError(
+                f"Unknown classification method {method}. Choose from "
+                f"{', '.join(CLASSIFICATION_METHODS)}")
 
-        # The plan is to create a dummy classify function, which will classify
-        #   the DEM in equal intervals for now. Later update the logic, adding
-        #   more functionality.
-        # TODO Add functionality. Currently only Equal Interval
         stats = self.calc_stats()
-        min, max = stats['MIN'], stats['MAX']
-
-        intervals = 10  # Arbitrary
-        breaks = np.linspace(min, max, intervals)
-        txt_rules = f""
-        for i in range(len(breaks) - 1):
-            pair = breaks[i], breaks[i + 1]
-            txt_rules = txt_rules + f"\n{pair[0]} thru {pair[1]} = {i}"
-
-        alg_string = "grass7:r.reclass"
-        # Create parameters, saving the classified output raster at the
-        #   directory containing the raster
-        save_path = os.path.join(self.working_directory, "classified.tiff")
-        params = {
-            'input': self.raster,
-            'output': save_path,
-            'txtrules': txt_rules
-        }
+        if method == 'equal':
+            return np.linspace(stats['MIN'], stats['MAX'], intervals)
+
+        edges, counts = self.histogram(bins, method == 'equal_area')
+        if method == 'jenks':
+            breaks = _jenks_breaks(edges, counts, intervals)
+        else:
+            breaks = _quantile_breaks(edges, counts, intervals)
+        # The last bin of integer DEMs ends one past the maximum
+        breaks = np.clip(breaks, stats['MIN'], stats['MAX'])
+        breaks[0], breaks[-1] = stats['MIN'], stats['MAX']
+        return breaks
+
+    def classify(self, method='equal', intervals=10, breaks=None,
+                 save_path=None):
+        """
+        Classify the DEM into elevation zones, streaming it block by block.
+        Each class is numbered from 0, from the lowest zone up, see
+        `Classifier`. No-data pixels are kept as no-data.
+
+        Args:
+            method, intervals: Method and number of boundaries of the breaks,
+                               see `breaks`
+            breaks: Boundaries to use instead, e.g. [1000, 2000, 3000, 4000]
+                    for three zones
+            save_path: Path of the classified GTiff. Defaults to
+                       `classified.tiff` in the directory of the DEM.
+        Returns:
+            (result, save_path): result {Dict}: {
+                                     'OUTPUT': Path to the classified raster,
+                                     'BREAKS': Boundaries of the classes
+                                 }
+        """
+        if breaks is None:
+            breaks = self.breaks(method, intervals)
+        if save_path is None:
+            save_path = os.path.join(self.working_directory,
+                                     "classified.tiff")
+
+        dem = Raster(self.path, lazy=True)
+        low = high = None
+        if np.issubdtype(
+                gdal_array.GDALTypeCodeToNumericTypeCode(
+                    dem.profile['dtype']), np.integer):
+            stats = self.calc_stats()
+            if stats['COUNT']:
+                low, high = stats['MIN'], stats['MAX']
+        classifier = Classifier(breaks, self.nodata, low, high)
+
+        profile = dict(dem.profile,
+                       dtype=classifier.dtype,
+                       nodata=classifier.nodata,
+                       driver='GTiff',
+                       creation_options='deflate')
+        result = Raster()
+        result.create(profile, save_path, RasterWriter())
+        for window, block in dem.blocks(_stream_block_size(dem.profile)):
+            result.write_block(classifier(block), window)
+        result.write()
+        del result
+
+        return {'OUTPUT': save_path, 'BREAKS': list(classifier.breaks)}, \
+            save_path
+
+    def zone_layer(self, zones_path, layer_name=None, field=None):
+        """
+        Copy the zone polygons into an in-memory layer, numbering every zone
+        by the index of its id among the sorted ids, in the attribute
+        `zone_index`. The indices are dense whatever the ids are, so they fit
+        an Int32 raster, and the per-zone statistics are sized by the number
+        of zones.
+
+        Args:
+            zones_path: Path of the vector file of the zone polygons
+            layer_name: Layer of the zones in the file. Defaults to the
+                        first one.
+            field: Attribute used as the zone id. Defaults to the feature id.
+        Returns:
+            (zones, ids): In-memory ogr DataSource of the zones, and the
+                          sorted zone ids {numpy array}
+        """
+        vector = ogr.Open(zones_path)
+        layer = vector.GetLayerByName(layer_name) \
+            if layer_name is not None else vector.GetLayer(0)
+
+        features = []
+        for feature in layer:
+            geometry = feature.GetGeometryRef()
+            if geometry is None:
+                continue
+            if field is None:
+                features.append((feature.GetFID(), geometry.Clone()))
+            elif feature.IsFieldSetAndNotNull(field):
+                features.append((feature.GetField(field), geometry.Clone()))
+        ids, indices = np.unique([zone_id for zone_id, _ in features],
+                                 return_inverse=True)
+
+        srs = layer.GetSpatialRef()
+        zones = ogr.GetDriverByName('Memory').CreateDataSource('')
+        zones_layer = zones.CreateLayer(
+            'zones', srs.Clone() if srs is not None else None, ogr.wkbUnknown)
+        zones_layer.CreateField(ogr.FieldDefn('zone_index', ogr.OFTInteger))
+        definition = zones_layer.GetLayerDefn()
+        for (_, geometry), index in zip(features, indices):
+            feature = ogr.Feature(definition)
+            feature.SetGeometry(geometry)
+            feature.SetField('zone_index', int(index))
+            zones_layer.CreateFeature(feature)
+        del vector
+
+        return zones, ids
+
+    def rasterize_zones(self, zones, window):
+        """
+        Burn the zone indices of `zones`, as made by `zone_layer`, into a
+        window of the DEM grid. A pixel belongs to the zone containing its
+        centre. Only the window is held in memory, so the zones can be
+        streamed alongside the DEM blocks.
+
+        Args:
+            zones: In-memory ogr DataSource returned by `zone_layer`
+            window: (xoff, yoff, xsize, ysize) of the window
+        Returns:
+            zone_indices {numpy array}: Int32 zone indices, -1 outside of
+                                        every zone
+        """
+        xoff, yoff, xsize, ysize = window
+        x0, dx, rx, y0, ry, dy = self.gdalRast.GetGeoTransform()
+        window_rast = gdal.GetDriverByName('MEM').Create(
+            '', xsize, ysize, 1, gdal.GDT_Int32)
+        window_rast.SetGeoTransform((x0 + xoff * dx + yoff * rx, dx, rx,
+                                     y0 + xoff * ry + yoff * dy, ry, dy))
+        window_rast.SetProjection(self.gdalRast.GetProjectionRef())
+        window_band = window_rast.GetRasterBand(1)
+        window_band.Fill(-1)
+
+        gdal.RasterizeLayer(window_rast, [1], zones.GetLayer(0),
+                            options=['ATTRIBUTE=zone_index'])
+        return window_band.ReadAsArray()
+
+    def zonal_stats(self, zones_path, layer_name=None, field=None,
+                    breaks=None):
+        """
+        Elevation statistics and hypsometry of every zone polygon. The zones
+        are rasterized window by window alongside the DEM blocks (see
+        `rasterize_zones`), so neither is held whole in memory, and the cost
+        does not grow with the number of zones.
+
+        Args:
+            zones_path, layer_name, field: The zones, see `zone_layer`
+            breaks: Boundaries of the elevation bands of the hypsometry.
+                    Defaults to `self.breaks()`.
+        Returns:
+            (table, hypsometry) {pd.DataFrame}: Indexed by zone id.
+                table: Columns `count` (pixels), `area` (squared map
+                       units, or square metres for geographic DEMs),
+                       `mean`, `std`, `min` and `max` (elevation)
+                hypsometry: Area of every elevation band in every zone, one
+                            column per band
+        """
+        if breaks is None:
+            breaks = self.breaks()
+        classifier = Classifier(breaks, self.nodata)
+
+        row_areas = self._row_areas()
+        if row_areas is None:
+            _, dx, _, _, _, dy = self.gdalRast.GetGeoTransform()
+            row_areas = np.full(self.gdalRast.RasterYSize, abs(dx * dy))
+
+        stats = self.calc_stats()
+        shift = stats['MEAN'] if stats['COUNT'] else 0.0
+
+        zones, ids = self.zone_layer(zones_path, layer_name, field)
+        dem = Raster(self.path, lazy=True)
+        windows = list(dem.block_windows(_stream_block_size(dem.profile)))
+        indices, stats, hypsometry = _stream_zonal_stats(
+            ((window, dem.read_block(window)) for window in windows),
+            (self.rasterize_zones(zones, window) for window in windows),
+            self.nodata, classifier, row_areas, shift)
 
-        result = processing.runAndLoadResults(alg_string, params)
-        return result, save_path
+        index = pd.Index(ids[indices], name='zone')
+        table = pd.DataFrame(stats, index=index)
+        labels = [f"{low:g}-{high:g}"
+                  for low, high in zip(classifier.breaks[:-1],
+                                       classifier.breaks[1:])]
+        hypsometry = pd.DataFrame(hypsometry, index=index, columns=labels)
+        return table, hypsometry
 
     def as_array(self, band=1):
         """Return the band array as a numpy array object
@@ -4,39 +4,290 @@ import numpy.ma as ma
 import tempfile
 import os
 import re
-from shutil import copyfile
+import sys
 import math
+from collections import deque
+import itertools
+import json
+import uuid
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from .backends import DEFAULT_BACKEND
 
 gdal.UseExceptions()
 
+# GTiff creation options of the output profiles. Rasters are tiled, so that
+# they can be read block by block, and BIGTIFF is used only when needed.
+CREATION_PROFILES = {
+    'default': [],
+    'deflate': ['TILED=YES', 'BLOCKXSIZE=512', 'BLOCKYSIZE=512',
+                'COMPRESS=DEFLATE', 'BIGTIFF=IF_SAFER'],
+    'zstd': ['TILED=YES', 'BLOCKXSIZE=512', 'BLOCKYSIZE=512',
+             'COMPRESS=ZSTD', 'BIGTIFF=IF_SAFER'],
+    'lzw': ['TILED=YES', 'BLOCKXSIZE=512', 'BLOCKYSIZE=512',
+            'COMPRESS=LZW', 'BIGTIFF=IF_SAFER'],
+}
+
+# Creation options of `CREATION_PROFILES` that are passed on to COG outputs
+COG_OPTIONS = ('COMPRESS', 'PREDICTOR', 'LEVEL')
+
+
+def _creation_options(creation_options):
+    """GTiff creation options from the name of one of `CREATION_PROFILES`,
+    or from a list of options, which is used as is. None gives the default,
+    uncompressed layout.
+
+    The profiles leave out PREDICTOR, which does not help class maps. For
+    continuous rasters such as DEMs, pass e.g.
+    `CREATION_PROFILES['deflate'] + ['PREDICTOR=2']`.
+    """
+    if creation_options is None:
+        return CREATION_PROFILES['default']
+    if isinstance(creation_options, str):
+        if creation_options not in CREATION_PROFILES:
+            raise ValueError(
+                f"Unknown creation profile {creation_options}. Choose from "
+                f"{', '.join(CREATION_PROFILES)} or pass a list of options")
+        return CREATION_PROFILES[creation_options]
+    return list(creation_options)
+
+
+def _raster_name(path):
+    """Name of the raster at `path`, used to name the outputs derived from it
+    """
+    name = re.split(r'[/\\]', path)[-1]
+    stem, extension = os.path.splitext(name)
+    if extension.lower() in ('.tif', '.tiff', '.vrt'):
+        return stem
+    return name
+
+
+def _stream_block_size(profile, pixels=2**22):
+    """(xsize, ysize) of full-width windows of about `pixels` pixels, made of
+    whole natural blocks, in which a raster is streamed. Rasters stored in
+    single-row strips would otherwise be read one row at a time.
+    """
+    cols = profile['cols']
+    block_y = profile['block_size'][1]
+    blocks = max(1, pixels // (cols * block_y))
+    return cols, min(profile['rows'], blocks * block_y)
+
+
+def _write_vrt(savepath, source, backend=DEFAULT_BACKEND):
+    """Write `savepath` as a VRT referencing the raster `source`, in place of
+    a copy of it. A GeoTIFF of the same name is removed, so that a directory
+    never lists the same raster twice.
+    """
+    stale = f"{os.path.splitext(savepath)[0]}.tif"
+    if backend.exists(stale):
+        backend.remove(stale)
+    backend.build_vrt(savepath, [os.path.abspath(source)])
+
+
+def _remove_vrt(savepath, backend=DEFAULT_BACKEND):
+    """Remove the VRT previously standing for the GeoTIFF `savepath`"""
+    stale = f"{os.path.splitext(savepath)[0]}.vrt"
+    if backend.exists(stale):
+        backend.remove(stale)
+
+
+def _write_time_index(directory, backend=DEFAULT_BACKEND):
+    """Write `{directory}.vrt`, stacking the rasters of `directory` as one
+    band per date, in temporal order.
+    """
+    files = _list_rasters(directory, backend)
+    if not files:
+        return None
+    savepath = f"{directory.rstrip(os.sep)}.vrt"
+    backend.build_vrt(savepath, files, separate=True)
+    return savepath
+
+
+def _combined_name(terra_path, aqua_path):
+    """Name of the step1 raster combining a Terra and an Aqua raster"""
+    return f"{_raster_name(terra_path)}_{_raster_name(aqua_path)}_combined"
+
+
+class RasterWriter:
+    """Creates the output rasters of a run.
+
+    The GDAL drivers and the spatial reference are resolved once and reused
+    for every raster the writer creates, and result arrays can be computed
+    into buffers reused from one raster to the next.
+
+    The rasters are created in `backend`, by default as files on disk.
+    Rasters written in the background by a `WriteQueue` still read their
+    buffer, so up to `buffers` of them are cycled through per shape.
+    """
+    def __init__(self, backend=DEFAULT_BACKEND, buffers=1):
+        self.backend = backend
+        self._buffer_count = buffers
+        self._drivers = dict()
+        self._srs_wkt = None
+        self._buffers = dict()
+
+    def driver(self, name):
+        if name not in self._drivers:
+            self._drivers[name] = self.backend.driver(name)
+        return self._drivers[name]
+
+    def srs_wkt(self, profile):
+        """WKT of the spatial reference of the rasters made from `profile`:
+        the projection of the source raster (`profile['proj']`). Profiles
+        without one fall back to EPSG:4326.
+        """
+        if profile.get('proj'):
+            return profile['proj']
+
+        if self._srs_wkt is None:
+            out_rast_SRS = osr.SpatialReference()
+            out_rast_SRS.ImportFromEPSG(4326)
+            self._srs_wkt = out_rast_SRS.ExportToWkt()
+        return self._srs_wkt
+
+    def buffer(self, shape, dtype):
+        """Array of `shape` and `dtype`, reused by the calls with the same
+        shape and dtype. Its content is only valid until `buffers` more such
+        calls.
+        """
+        key = (tuple(shape), np.dtype(dtype))
+        ring = self._buffers.setdefault(key, deque())
+        if len(ring) < self._buffer_count:
+            array = np.empty(shape, dtype=dtype)
+        else:
+            array = ring.popleft()
+        ring.append(array)
+        return array
+
+
 class Raster:
-    def __init__(self, path=None):
-        self.rast = None
+    def __init__(self, path=None, lazy=False, memmap=False,
+                 backend=DEFAULT_BACKEND):
+        """
+        Args:
+            path: Path of the raster to open. If None, an empty Raster is
+                  created which can be filled using `array_to_rast` or
+                  `create`.
+            lazy: If True, only open the dataset and read its profile. The
+                  band is not decoded, and can be accessed block by block
+                  using `blocks()`/`read_block()`.
+            memmap: If True, and the raster is an uncompressed strip GTiff,
+                    the band is memory-mapped instead of being copied into
+                    memory. The map is copy-on-write: changing `data` never
+                    changes the file. Other rasters are read as usual.
+            backend: Backend the raster is stored in (see `backends`). By
+                     default, a file read by GDAL.
+
+        The band is exposed as the plain array `data`. The masked array
+        `rast` (no-data values masked) is only built when it is accessed.
+        """
+        self.data = None
+        self._rast = None
         self.profile = dict()
 
         self._gdal_rast = None
         self._gdal_band = None
+        self._memmap = memmap
+        self._scratch_directory = None
+        self.backend = backend
 
         if path is not None:
             self.path = path
-            self.read()
+            if lazy:
+                self.open()
+            else:
+                self.read()
         else:
             self.path = None
 
     def read(self):
         print(f"Reading file: {self.path}")
-        self.rast, self._gdal_rast, self._gdal_band = self._read()
+        self.data, self._gdal_rast, self._gdal_band = self._read()
+        self._rast = None
+        self.profile.update(self._read_profile())
+
+    @property
+    def rast(self):
+        """The band as a masked array, with the no-data values masked. It
+        shares its memory with `data`, and the mask is only made on first
+        access.
+        """
+        if self._rast is None and self.data is not None:
+            self._rast = ma.MaskedArray(self.data, mask=self.mask, copy=False)
+        return self._rast
+
+    @property
+    def mask(self):
+        """Boolean mask of the no-data pixels, or `ma.nomask` if the raster
+        has no no-data value.
+        """
+        nodata = self.profile.get('nodata')
+        if self.data is None or nodata is None:
+            return ma.nomask
+        if np.isnan(nodata):
+            return np.isnan(self.data)
+        return self.data == nodata
+
+    def open(self):
+        """Open the raster without reading the band into memory"""
+        print(f"Opening file: {self.path}")
+        self._gdal_rast = self.backend.open(self.path)
+        self._gdal_band = self._gdal_rast.GetRasterBand(1)
         self.profile.update(self._read_profile())
 
     def _read(self):
-        raster = gdal.Open(self.path)
+        raster = self.backend.open(self.path)
 
         band = raster.GetRasterBand(1)
-        nodata = band.GetNoDataValue()
-        arr = band.ReadAsArray()
-        masked_raster = ma.masked_equal(arr, nodata)
-
-        return masked_raster, raster, band
+        arr = self._map_band(raster, band) if self._memmap else None
+        if arr is None:
+            arr = band.ReadAsArray()
+
+        return arr, raster, band
+
+    def _map_band(self, raster, band):
+        """Memory-map the band of an uncompressed, single band strip GTiff
+        whose strips are stored one after the other. Returns None for any
+        other layout, which then has to be decoded by GDAL.
+        """
+        if raster.GetDriver().ShortName != 'GTiff' \
+                or raster.RasterCount != 1 \
+                or not os.path.isfile(self.path):
+            return None
+        if raster.GetMetadata('IMAGE_STRUCTURE').get('COMPRESSION'):
+            return None
+
+        cols, rows = raster.RasterXSize, raster.RasterYSize
+        block_x, block_y = band.GetBlockSize()
+        if block_x != cols:
+            # Tiled
+            return None
+
+        dtype = np.dtype(
+            gdal_array.GDALTypeCodeToNumericTypeCode(band.DataType))
+        with open(self.path, 'rb') as f:
+            byte_order = f.read(2)
+        native = b'II' if sys.byteorder == 'little' else b'MM'
+        if byte_order != native:
+            return None
+
+        strip_bytes = block_y * cols * dtype.itemsize
+        offsets = [band.GetMetadataItem(f'BLOCK_OFFSET_0_{strip}', 'TIFF')
+                   for strip in range(math.ceil(rows / block_y))]
+        if None in offsets:
+            return None
+        offsets = [int(offset) for offset in offsets]
+        if offsets != list(range(offsets[0],
+                                 offsets[0] + len(offsets) * strip_bytes,
+                                 strip_bytes)):
+            return None
+        if offsets[0] + rows * cols * dtype.itemsize \
+                > os.path.getsize(self.path):
+            return None
+
+        return np.memmap(self.path, dtype=dtype, mode='c',
+                         offset=offsets[0], shape=(rows, cols))
 
     def _read_profile(self):
         profile = dict()
@@ -51,53 +302,148 @@ class Raster:
         profile['driver'] = "GTiff"
         profile['nodata'] = self._gdal_band.GetNoDataValue()
         profile['path'] = self.path
-        profile['dtype'] = self._nptype_to_gdaltype(self.rast.data.dtype)
+        profile['dtype'] = self._gdal_band.DataType
         profile['geotransform'] = self._gdal_rast.GetGeoTransform()
         profile['proj'] = self._gdal_rast.GetProjectionRef()
-        profile['shape'] = self.rast.shape
+        profile['shape'] = (self._gdal_rast.RasterYSize,
+                            self._gdal_rast.RasterXSize)
         profile['cols'] = self._gdal_rast.RasterXSize
         profile['rows'] = self._gdal_rast.RasterYSize
-        profile['name'] = re.split(r'[/\\]', self.path)[-1].rstrip('.tif')
+        profile['block_size'] = tuple(self._gdal_band.GetBlockSize())
+        profile['name'] = _raster_name(self.path)
 
         return profile
 
+    def block_windows(self, block_size=None):
+        """Iterate over the windows covering the raster.
+
+        Args:
+            block_size: (xsize, ysize) of the windows. Defaults to the natural
+                        block size of the band (strips or tiles for GTiff).
+        Yields:
+            window {tuple}: (xoff, yoff, xsize, ysize) of every block, row by
+                            row. Edge blocks are clipped to the raster extent.
+        """
+        if block_size is None:
+            block_size = self.profile['block_size']
+        block_x, block_y = block_size
+        cols, rows = self.profile['cols'], self.profile['rows']
+
+        for yoff in range(0, rows, block_y):
+            ysize = min(block_y, rows - yoff)
+            for xoff in range(0, cols, block_x):
+                xsize = min(block_x, cols - xoff)
+                yield xoff, yoff, xsize, ysize
+
+    def blocks(self, block_size=None):
+        """Iterate over the raster block by block, so that at most one block
+        is held in memory at a time.
+
+        Args:
+            block_size: See `block_windows`.
+        Yields:
+            (window, array): window as returned by `block_windows` and the
+                             array read from that window.
+        """
+        for window in self.block_windows(block_size):
+            yield window, self.read_block(window)
+
+    def read_block(self, window):
+        """Read the (xoff, yoff, xsize, ysize) `window` of the band"""
+        xoff, yoff, xsize, ysize = window
+        return self._gdal_band.ReadAsArray(xoff, yoff, xsize, ysize)
+
+    def write_block(self, array, window):
+        """Write `array` into the band at the (xoff, yoff, ...) `window`.
+        The raster must have been created by `create` or `array_to_rast`.
+        """
+        xoff, yoff = window[:2]
+        self._gdal_band.WriteArray(array, xoff, yoff)
+
     def _nptype_to_gdaltype(self, t):
         return gdal_array.NumericTypeCodeToGDALTypeCode(t)
 
-    def array_to_rast(self, array, profile, path=None):
+    def _gdal_type(self, dtype):
+        """GDAL type code of `dtype`, either a GDAL type code or a numpy
+        type. None gives Byte.
+        """
+        if dtype is None:
+            return gdal.GDT_Byte
+        if isinstance(dtype, int):
+            return dtype
+        return self._nptype_to_gdaltype(np.dtype(dtype))
+
+    def create(self, profile, path=None, writer=None):
+        """Create an empty raster described by `profile` at `path`. The band
+        can then be filled using `write_block`, and flushed using `write`.
+
+        The data type is taken from `profile['dtype']`, and the GTiff
+        creation options from `profile['creation_options']`: either the name
+        of one of `CREATION_PROFILES` or a list of options.
+
+        If `profile['driver']` is 'COG', a Cloud-Optimized GeoTIFF with
+        internal overviews is written by `write`, resampled with
+        `profile['overview_resampling']` (NEAREST by default, which keeps
+        class maps categorical).
+
+        Pass the `RasterWriter` of the run as `writer` to reuse its driver
+        and spatial reference. The raster is created in the backend of
+        `writer`, or else in the backend of this Raster.
+        """
         self.profile = profile
         self.path = path
+        if writer is None:
+            writer = RasterWriter(self.backend)
+        self.backend = writer.backend
 
         if path is None:
             f = tempfile.NamedTemporaryFile(suffix='.tif')
             path = f.name
 
-        driver = gdal.GetDriverByName(self.profile['driver'])
+        if self.profile['driver'] == 'COG':
+            # A COG can only be made as a copy of a complete raster, so the
+            # band is first written to a tiled scratch GTiff
+            driver = writer.driver('GTiff')
+            self.path = path
+            path = self._cog_scratch_path(path)
+            options = ['TILED=YES', 'BIGTIFF=IF_SAFER']
+        else:
+            driver = writer.driver(self.profile['driver'])
+            options = _creation_options(self.profile.get('creation_options'))
 
         out_raster = driver.Create(
             path,
             self.profile['cols'],
-            self.profile['rows'])
+            self.profile['rows'],
+            1,
+            self._gdal_type(self.profile.get('dtype')),
+            options)
 
         out_raster.SetGeoTransform(self.profile['geotransform'])
         out_band = out_raster.GetRasterBand(1)
-        out_band.SetNoDataValue(profile['nodata'])
-        out_band.WriteArray(array)
+        if profile.get('nodata') is not None:
+            out_band.SetNoDataValue(profile['nodata'])
 
-        out_rast_SRS = osr.SpatialReference()
-        # FIXME Allow other EPSGs to be used as spatial reference
-        out_rast_SRS.ImportFromEPSG(4326)
-        out_raster.SetProjection(out_rast_SRS.ExportToWkt())
+        out_raster.SetProjection(writer.srs_wkt(self.profile))
 
         self._gdal_rast = out_raster
         self._gdal_band = out_band
 
         return out_raster
 
+    def array_to_rast(self, array, profile, path=None, writer=None):
+        out_raster = self.create(profile, path, writer)
+        self._gdal_band.WriteArray(array)
+
+        return out_raster
+
     def write(self):
         print(f'Writing at: {self.path}')
         self._gdal_band.FlushCache()
 
+        if self.profile.get('driver') == 'COG':
+            self._write_cog()
+
         # if path is None and self.path is None:
         #     raise Exception("Path not defined")
         # elif path is None and self.path is not None:
@@ -107,6 +453,72 @@ class Raster:
         # FIXME Add functionality of path. Path can be chosen, such that the
         #  result can be saved by passing path parameter
 
+    def _cog_scratch_path(self, path):
+        """Path of the scratch GTiff the COG at `path` is copied from. It is
+        kept out of the step directories, where `_list_rasters` would find it
+        if it were left behind: on disk, in a temporary directory removed
+        with it, or in memory for backends which are in memory anyway.
+        """
+        name = os.path.basename(path)
+        if not self.backend.persistent:
+            return f"/vsimem/{uuid.uuid4().hex}_{name}"
+        self._scratch_directory = tempfile.TemporaryDirectory()
+        return os.path.join(self._scratch_directory.name, name)
+
+    def _write_cog(self):
+        """Copy the scratch raster made by `create` into a Cloud-Optimized
+        GeoTIFF at `self.path`, building its overviews once.
+        """
+        scratch = self._gdal_rast
+        scratch_path = scratch.GetDescription()
+        resampling = self.profile.get('overview_resampling', 'NEAREST')
+        compression = self.profile.get('creation_options')
+
+        driver = self.backend.driver('COG')
+        if driver is not None:
+            options = ['BLOCKSIZE=512', 'BIGTIFF=IF_SAFER',
+                       f'OVERVIEW_RESAMPLING={resampling}']
+        else:
+            # GDAL < 3.1 has no COG driver; a tiled GTiff with the overviews
+            # copied in front of the data is laid out the same way
+            scratch.BuildOverviews(resampling, self._overview_levels())
+            driver = self.backend.driver('GTiff')
+            options = ['TILED=YES', 'BLOCKXSIZE=512', 'BLOCKYSIZE=512',
+                       'COPY_SRC_OVERVIEWS=YES', 'BIGTIFF=IF_SAFER']
+
+        if isinstance(compression, str) and compression != 'default':
+            options.append(f'COMPRESS={compression.upper()}')
+        elif isinstance(compression, (list, tuple)):
+            # Only the compression settings apply to the COG driver, which
+            # does its own tiling
+            options.extend(option for option in compression
+                           if option.split('=')[0].upper() in COG_OPTIONS)
+
+        out_raster = driver.CreateCopy(self.path, scratch, options=options)
+
+        self._gdal_band = None
+        self._gdal_rast = None
+        del scratch
+        self.backend.driver('GTiff').Delete(scratch_path)
+        if self._scratch_directory is not None:
+            self._scratch_directory.cleanup()
+            self._scratch_directory = None
+
+        self._gdal_rast = out_raster
+        self._gdal_band = out_raster.GetRasterBand(1)
+
+    def _overview_levels(self, min_size=512):
+        """Overview decimation factors, halving until the raster fits in a
+        `min_size` block.
+        """
+        levels = []
+        factor = 2
+        while max(self.profile['rows'], self.profile['cols']) / factor \
+                >= min_size:
+            levels.append(factor)
+            factor *= 2
+        return levels or [2]
+
     def _generate_temp_file_path(self):
         # For creating rasters temporarily, before saving it permanently in
         #  some other location
@@ -119,16 +531,753 @@ class Raster:
         return temp_filepath
 
     def __del__(self):
-        del self.rast
+        self._rast = None
+        self.data = None
+
+class PrefetchReader:
+    """Reads a sequence of rasters in order, decoding the next `depth` of
+    them on background threads while the current one is being processed.
+
+    GDAL releases the GIL while it reads and decodes, so the reads overlap
+    with the computation and writing of the caller. At most `depth + 1`
+    rasters are held in memory at a time.
+    """
+    def __init__(self, paths, depth=1, **kwargs):
+        """
+        Args:
+            paths: Paths of the rasters, in the order they are processed in
+            depth: Number of rasters read ahead. 0 reads every raster when
+                   it is needed, on the calling thread.
+            kwargs: Arguments of `Raster`, e.g. `memmap` or `backend`
+        """
+        self.paths = paths
+        self.depth = depth
+        self.kwargs = kwargs
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __iter__(self):
+        """
+        Yields:
+            raster: The Raster of every path, in order
+        """
+        if self.depth < 1:
+            for path in self.paths:
+                yield Raster(path, **self.kwargs)
+            return
+
+        paths = iter(self.paths)
+        with ThreadPoolExecutor(max_workers=self.depth) as executor:
+            pending = deque(executor.submit(Raster, path, **self.kwargs)
+                            for path in itertools.islice(paths, self.depth))
+            while pending:
+                # Errors raised while reading are raised here, in order
+                raster = pending.popleft().result()
+                for path in itertools.islice(paths, 1):
+                    pending.append(
+                        executor.submit(Raster, path, **self.kwargs))
+                yield raster
+
+
+class WriteQueue:
+    """Runs the writes of a step on background threads, so that the next
+    scene is computed while the previous results are being flushed.
+
+    At most `max_pending` writes are queued or running at a time; submitting
+    another one waits for the oldest. An error raised by a write is raised
+    again in the caller, by the `submit` or `join` that waits for it.
+    """
+    def __init__(self, threads=1, max_pending=2):
+        """
+        Args:
+            threads: Number of writer threads. 0 runs every write when it is
+                     submitted, on the calling thread.
+            max_pending: Maximum number of writes queued or running
+        """
+        self.threads = threads
+        self.max_pending = max(1, max_pending)
+        self._pending = deque()
+        self._executor = ThreadPoolExecutor(max_workers=threads) \
+            if threads > 0 else None
+
+    @property
+    def buffers(self):
+        """Number of result buffers needed to compute the next result while
+        the pending ones are written from theirs.
+        """
+        return self.max_pending + 1 if self._executor is not None else 1
+
+    def submit(self, fn, *args):
+        """Call `fn(*args)` on a writer thread"""
+        if self._executor is None:
+            fn(*args)
+            return
+        while len(self._pending) >= self.max_pending:
+            self._pending.popleft().result()
+        self._pending.append(self._executor.submit(fn, *args))
+
+    def join(self):
+        """Wait for every pending write"""
+        while self._pending:
+            self._pending.popleft().result()
+
+    def close(self):
+        try:
+            self.join()
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        elif self._executor is not None:
+            # The step has failed: drop the writes not started yet
+            for future in self._pending:
+                future.cancel()
+            self._executor.shutdown(wait=True)
+
+
+def _write_raster(array, profile, savepath, writer):
+    """Write `array` as a new raster described by `profile` at `savepath`"""
+    result = Raster()
+    result.array_to_rast(array, profile, savepath, writer)
+    result.write()
+    del result
+
+
+class TemporalWindow:
+    """Sliding window over a date-ordered sequence of rasters.
+
+    Every raster is read exactly once, when it enters the window, and is
+    dropped as soon as it leaves it. The window is held in a ring buffer of
+    `2 * radius + 1` rasters.
+    """
+    def __init__(self, files, radius=2, start=0, stop=None, memmap=True,
+                 backend=DEFAULT_BACKEND, prefetch=1):
+        """
+        Args:
+            files: Paths of the rasters, sorted by date
+            radius: Number of neighbours on either side of the current raster
+            start, stop: Range of indices of `files` the window is centred
+                         on. The neighbours outside the range (the halo) are
+                         still read.
+            memmap: Memory-map the rasters when their layout allows it, so
+                    that they are served from the page cache
+            backend: Backend the rasters are read from
+            prefetch: Number of rasters read ahead of the window on
+                      background threads (see `PrefetchReader`)
+        """
+        self.files = files
+        self.radius = radius
+        self.start = start
+        self.stop = len(files) if stop is None else stop
+        self.memmap = memmap
+        self.backend = backend
+        self.prefetch = prefetch
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __iter__(self):
+        """
+        Yields:
+            (index, window): index of the current raster in `files` and the
+                             list of `2 * radius + 1` Rasters centred on it.
+                             Neighbours falling outside the sequence are None.
+        """
+        n = len(self.files)
+        buffer = deque(maxlen=2 * self.radius + 1)
+        next_to_read = max(0, self.start - self.radius)
+        # Rasters enter the window in order, so they can be read ahead
+        reader = iter(PrefetchReader(
+            self.files[next_to_read:min(n, self.stop + self.radius)],
+            self.prefetch, memmap=self.memmap, backend=self.backend))
+
+        for index in range(self.start, self.stop):
+            # Read the rasters entering the window
+            while next_to_read < min(n, index + self.radius + 1):
+                buffer.append((next_to_read, next(reader)))
+                next_to_read += 1
+            # Drop the rasters which have left the window
+            while buffer[0][0] < index - self.radius:
+                buffer.popleft()
+
+            loaded = dict(buffer)
+            window = [loaded.get(i)
+                      for i in range(index - self.radius,
+                                     index + self.radius + 1)]
+            yield index, window
+
+
+def _build_gap_fill_lut():
+    """Build the lookup table of the step_2 gap-filling rules.
+
+    Each neighbour is reduced to a class code: 0 for anything else, 1 for
+    no-snow (2) and 2 for snow (3). The codes of (previous_2, previous,
+    next_, next_2) are packed as base-3 digits, and the table maps the packed
+    code to the value a cloud/no-data pixel is replaced with (0 if it is left
+    as is).
+    """
+    classes = (None, 2, 3)
+    lut = np.zeros(3 ** 4, dtype=np.uint8)
+
+    for codes in itertools.product(range(3), repeat=4):
+        previous_2, previous, next_, next_2 = (classes[c] for c in codes)
+        fill = 0
+        # Same order as the rules were applied in; later rules win
+        for before, after in ((previous, next_),
+                              (previous_2, next_),
+                              (previous, next_2)):
+            for value in (3, 2):
+                if before == value and after == value:
+                    fill = value
+
+        packed = ((codes[0] * 3 + codes[1]) * 3 + codes[2]) * 3 + codes[3]
+        lut[packed] = fill
+
+    return lut
+
+
+_GAP_FILL_LUT = _build_gap_fill_lut()
+
+
+class GapFillKernel:
+    """Fused kernel for the step_2 snow/no-snow gap filling.
+
+    Cloud (1) or no-data (0) pixels of the current raster are replaced by
+    snow (3) or no-snow (2) when both a previous and a next raster agree on
+    it, considering the pairs (previous, next_), (previous_2, next_) and
+    (previous, next_2). All the rules are evaluated in a single lookup over
+    the packed neighbour classes, and the work buffers are reused between
+    calls of the same shape.
+    """
+    def __init__(self):
+        self._shape = None
+        self._code = None
+        self._mask = None
+        self._gap = None
+
+    def _buffers(self, shape):
+        if shape != self._shape:
+            self._shape = shape
+            self._code = np.empty(shape, dtype=np.uint8)
+            self._mask = np.empty(shape, dtype=bool)
+            self._gap = np.empty(shape, dtype=bool)
+        return self._code, self._mask, self._gap
+
+    def __call__(self, current, previous, next_, previous_2=None,
+                 next_2=None, out=None):
+        """
+        Args:
+            current, previous, next_: Arrays of the current raster and its
+                                      immediate neighbours
+            previous_2, next_2: Arrays of the neighbours two days away. If
+                                None, the rules using them are skipped.
+            out: Array to write the result into. Allocated if None.
+        Returns:
+            out {numpy array}: Gap-filled copy of `current`
+        """
+        code, mask, gap = self._buffers(current.shape)
+
+        code.fill(0)
+        for neighbour in (previous_2, previous, next_, next_2):
+            np.multiply(code, 3, out=code)
+            if neighbour is None:
+                continue
+            np.equal(neighbour, 2, out=mask)
+            np.add(code, mask, out=code, casting='unsafe')
+            np.equal(neighbour, 3, out=mask)
+            np.add(code, mask, out=code, casting='unsafe')
+            np.add(code, mask, out=code, casting='unsafe')
+
+        np.take(_GAP_FILL_LUT, code, out=code)
+
+        # Only cloud or no-data pixels are filled
+        np.equal(current, 0, out=gap)
+        np.equal(current, 1, out=mask)
+        np.logical_or(gap, mask, out=gap)
+        np.multiply(code, gap, out=code, casting='unsafe')
+        np.not_equal(code, 0, out=mask)
+
+        if out is None:
+            out = np.empty_like(current)
+        np.copyto(out, current)
+        np.copyto(out, code, where=mask, casting='unsafe')
+
+        return out
+
+
+def fill_gaps(current, previous, next_, previous_2=None, next_2=None):
+    """Convenience wrapper around a one-off `GapFillKernel`"""
+    return GapFillKernel()(current, previous, next_, previous_2, next_2)
+
+
+def _snowline_elevations(dem_arr, step=5):
+    """Elevations, `step` m apart, at which the snowline is searched for"""
+    return np.arange(
+        math.floor(np.nanmin(dem_arr)),
+        math.ceil(np.nanmax(dem_arr)+1),
+        step=step
+    )
+
+
+def _cloud_percentage(band):
+    """Percentage of the pixels of `band` which are cloud (1)"""
+    return (np.count_nonzero(band == 1)/(band.shape[0] * band.shape[1]))*100
+
+
+class SnowlineIndex:
+    """DEM pixels sorted by elevation, and binned at the elevations the
+    snowline is searched at.
+
+    The index is built once per DEM. Filling a scene then only needs one
+    gather of the scene in elevation order: the lowest snow pixel and the
+    highest no-snow pixel are found in a single pass, and the pixels below or
+    above the matching elevation are contiguous slices of the sorted scene.
+    """
+    def __init__(self, order, upper, lower, shape):
+        """
+        Args:
+            order: Flat indices of the DEM pixels, sorted by elevation.
+                   Pixels without elevation (NaN) are left out.
+            upper: For every elevation, number of pixels at or below it
+            lower: For every elevation, number of pixels below it
+            shape: Shape of the DEM
+        """
+        self.order = order
+        self.upper = upper
+        self.lower = lower
+        self.shape = tuple(int(size) for size in shape)
+
+    @classmethod
+    def from_dem(cls, dem_arr, step=5):
+        """Build the index of `dem_arr`, binned every `step` m"""
+        elevations = _snowline_elevations(dem_arr, step)
+
+        flat = dem_arr.reshape(-1)
+        order = np.argsort(flat, kind='stable')
+        sorted_dem = flat[order]
+        # NaNs are sorted last, and are neither below nor above any elevation
+        if np.issubdtype(sorted_dem.dtype, np.floating):
+            valid = np.count_nonzero(~np.isnan(sorted_dem))
+            order, sorted_dem = order[:valid], sorted_dem[:valid]
+
+        upper = np.searchsorted(sorted_dem, elevations, side='right')
+        lower = np.searchsorted(sorted_dem, elevations, side='left')
+
+        return cls(order, upper, lower, dem_arr.shape)
+
+    @classmethod
+    def for_dem(cls, dem_path, step=5, backend=DEFAULT_BACKEND):
+        """Return the index of the DEM at `dem_path`.
+
+        The index is cached next to the DEM, keyed by the path and
+        modification time of the DEM and by `step`. When the cache is
+        current, the DEM is not read at all. DEMs of a non-persistent
+        `backend` are not cached.
+        """
+        if not backend.persistent:
+            return cls.from_dem(Raster(dem_path, backend=backend).data, step)
+
+        cache_path = f"{dem_path}.snowline_{step}m.npz"
+        key = {
+            'dem_path': os.path.abspath(dem_path),
+            'mtime': os.path.getmtime(dem_path),
+            'step': step,
+        }
+
+        index = cls._load(cache_path, key)
+        if index is not None:
+            print(f"Using cached snowline index: {cache_path}")
+            return index
+
+        index = cls.from_dem(
+            Raster(dem_path, memmap=True, backend=backend).data, step)
+        index._save(cache_path, key)
+        return index
+
+    @classmethod
+    def _load(cls, cache_path, key):
+        if not os.path.isfile(cache_path):
+            return None
+        try:
+            with np.load(cache_path) as cached:
+                if any(cached[k].item() != v for k, v in key.items()):
+                    return None
+                return cls(cached['order'], cached['upper'],
+                           cached['lower'], cached['shape'])
+        except (OSError, KeyError, ValueError, EOFError,
+                zipfile.BadZipFile) as e:
+            print(f"Ignoring unreadable snowline index {cache_path}: {e}")
+            return None
+
+    def _save(self, cache_path, key):
+        # Written under a temporary name first, so that an interrupted run
+        # never leaves a truncated index behind
+        temp_path = f"{cache_path}.{os.getpid()}.tmp.npz"
+        try:
+            np.savez(temp_path, order=self.order, upper=self.upper,
+                     lower=self.lower, shape=np.array(self.shape), **key)
+            os.replace(temp_path, cache_path)
+        except OSError as e:
+            print(f"Could not cache the snowline index at {cache_path}: {e}")
+
+    def fill(self, band):
+        """Fill the clouds of `band` in place using the snowline.
+
+        Cloud (1) pixels at or below the lowest elevation with snow are
+        marked as no-snow (2). Then, cloud pixels at or above the highest
+        elevation with no-snow are marked as snow (3).
+
+        Args:
+            band: Classified raster array, of the same shape as the DEM
+        """
+        if band.shape != self.shape:
+            raise ValueError(
+                f"Raster of shape {band.shape} does not match the DEM of "
+                f"shape {self.shape}. The DEM must be on the grid of the "
+                f"scenes.")
+        sorted_band = band.take(self.order)
+
+        is_snow = sorted_band == 3
+        if is_snow.any():
+            # Lowest elevation having a snow pixel at or below it
+            first_snow = np.argmax(is_snow)
+            i = np.searchsorted(self.upper, first_snow, side='right')
+            if i < len(self.upper):
+                below = sorted_band[:self.upper[i]]
+                below[below == 1] = 2
+
+        is_nosnow = sorted_band[::-1] == 2
+        if is_nosnow.any():
+            # Highest elevation having a no-snow pixel at or above it
+            last_nosnow = len(sorted_band) - 1 - np.argmax(is_nosnow)
+            j = np.searchsorted(self.lower, last_nosnow, side='right') - 1
+            if j >= 0:
+                above = sorted_band[self.lower[j]:]
+                above[above == 1] = 3
+
+        band.put(self.order, sorted_band)
+
+
+def _merge_pairs(terra_paths, aqua_paths, savepaths, block_size=None,
+                 output_options=None, backend=DEFAULT_BACKEND,
+                 write_threads=1, max_pending_writes=2):
+    """Merge every Terra raster with its Aqua raster into the matching
+    `savepaths`, taking the maximum class of both. The rasters are streamed
+    block by block, so that only one block of each is held in memory at a
+    time. Each merged raster is flushed in the background while the next
+    pair is merged.
+    """
+    writer = RasterWriter(backend)
+
+    with WriteQueue(write_threads, max_pending_writes) as queue:
+        for terra_path, aqua_path, savepath in zip(terra_paths, aqua_paths,
+                                                   savepaths):
+            terra = Raster(terra_path, lazy=True, backend=backend)
+            aqua = Raster(aqua_path, lazy=True, backend=backend)
+
+            # Class maps only hold codes 0 to 3
+            profile = terra.profile
+            profile.update(dtype=gdal.GDT_Byte)
+            profile.update(output_options or {})
+
+            result = Raster()
+            result.create(profile, savepath, writer)
+            for window, terra_block in terra.blocks(
+                    block_size or _stream_block_size(terra.profile)):
+                aqua_block = aqua.read_block(window)
+                merged = writer.buffer(
+                    terra_block.shape,
+                    np.result_type(terra_block, aqua_block))
+                np.maximum(terra_block, aqua_block, out=merged)
+                result.write_block(merged, window)
+            # The blocks are already copied into the dataset, so the buffer
+            # can be reused while it is flushed
+            queue.submit(result.write)
+
+    return savepaths
+
+
+def _is_edge(index, n):
+    """True if step_2 passes the raster at `index` of `n` through unchanged"""
+    return index == 0 or index == n-1
+
+
+def _step_2_savepath(savedir, files, index, use_vrt=False):
+    extension = 'vrt' if use_vrt and _is_edge(index, len(files)) else 'tif'
+    return os.path.join(savedir,
+                        f"{_raster_name(files[index])}.{extension}")
+
+
+def _fill_gaps_range(files, savedir, start, stop, output_options=None,
+                     use_vrt=False, backend=DEFAULT_BACKEND, prefetch=1,
+                     write_threads=1, max_pending_writes=2):
+    """Run step_2 on the rasters `files[start:stop]`, writing the results
+    into `savedir`. The branch taken for every raster depends on its index
+    in the whole of `files`, so any split of the sequence gives the same
+    outputs as a single sweep. If `use_vrt`, the first and last rasters,
+    passed through unchanged, are written as VRTs of their inputs.
+    """
+    kernel = GapFillKernel()
+    queue = WriteQueue(write_threads, max_pending_writes)
+    # Results are computed into a ring of buffers, as the previous ones may
+    # still be being written
+    writer = RasterWriter(backend, buffers=queue.buffers)
+
+    with queue:
+        # Each step1 raster is read once, and kept only while it is within
+        # +-2 days of the current raster
+        for current_index, window in TemporalWindow(files, 2, start, stop,
+                                                    backend=backend,
+                                                    prefetch=prefetch):
+            previous_2, previous, current, next_, next_2 = window
+            print(f"{current_index} -> {files[current_index]}")
+
+            savepath = _step_2_savepath(savedir, files, current_index, use_vrt)
+            if use_vrt and _is_edge(current_index, len(files)):
+                _write_vrt(savepath, files[current_index], backend)
+                continue
+
+            if _is_edge(current_index, len(files)):
+                result_arr = current.data
+            else:
+                if current_index == 1 or current_index == len(files)-2:
+                    # Next to the ends of the sequence, only the immediate
+                    # neighbours are used
+                    previous_2 = next_2 = None
+
+                result_arr = kernel(
+                    current.data,
+                    previous.data,
+                    next_.data,
+                    previous_2.data if previous_2 is not None else None,
+                    next_2.data if next_2 is not None else None,
+                    out=writer.buffer(current.data.shape, current.data.dtype)
+                )
+
+            profile = dict(current.profile, **(output_options or {}))
+
+            _remove_vrt(savepath, backend)
+            queue.submit(_write_raster, result_arr, profile, savepath, writer)
+
+
+def _chunk_bounds(n, chunks):
+    """Bounds splitting `range(n)` into at most `chunks` contiguous, non-empty
+    and roughly equal chunks: chunk i is `range(bounds[i], bounds[i+1])`.
+    """
+    chunks = max(1, min(chunks, n))
+    return [round(i * n / chunks) for i in range(chunks + 1)]
+
+
+def _list_rasters(directory, backend=DEFAULT_BACKEND):
+    """Return the paths of the GeoTIFFs and VRTs in `directory`, sorted by
+    name so that date-stamped files are in temporal order.
+    """
+    return sorted(os.path.join(directory, f)
+                  for f in backend.listdir(directory)
+                  if f.endswith('.tif') or f.endswith('.vrt'))
+
+
+def _as_file_list(inputs, backend=DEFAULT_BACKEND):
+    """Paths of the rasters in `inputs`, either a directory or a list"""
+    if isinstance(inputs, str):
+        return _list_rasters(inputs, backend)
+    return list(inputs)
+
+
+class Manifest:
+    """Record of the outputs written in a working directory, and of the
+    inputs and parameters each of them was made from.
+
+    It is stored as JSON in the working directory, and lets a re-run skip the
+    outputs whose inputs have not changed since. Inputs are fingerprinted by
+    size and modification time, as hashing whole rasters would cost as much
+    as reading them.
+
+    The manifest of a non-persistent backend is only kept in memory, for the
+    lifetime of the run.
+    """
+    FILE_NAME = "manifest.json"
+
+    def __init__(self, working_directory, backend=DEFAULT_BACKEND):
+        self.path = os.path.join(working_directory, self.FILE_NAME)
+        self.entries = dict()
+        self.backend = backend
+
+        if backend.persistent and os.path.isfile(self.path):
+            try:
+                with open(self.path) as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"Ignoring unreadable manifest {self.path}: {e}")
+
+    def dependencies(self, inputs, **params):
+        """Describe an output made from the files `inputs` with `params`"""
+        fingerprints = []
+        for path in inputs:
+            size, mtime_ns = self.backend.stat(path)
+            fingerprints.append([os.path.abspath(path), size, mtime_ns])
+
+        # Normalised through JSON, so that it compares equal to the entries
+        # read back from the manifest
+        return json.loads(json.dumps({'inputs': fingerprints,
+                                      'params': params}))
+
+    def is_current(self, output, dependencies):
+        """Whether `output` exists, and was made from `dependencies`"""
+        return self.backend.exists(output) \
+            and self.entries.get(os.path.abspath(output)) == dependencies
+
+    def record(self, output, dependencies):
+        self.entries[os.path.abspath(output)] = dependencies
+
+    def save(self):
+        if not self.backend.persistent:
+            return
+        temp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(self.entries, f, indent=1)
+        os.replace(temp_path, self.path)
+
+
+def _step_2_inputs(files, index):
+    """The step1 rasters the step_2 result of `files[index]` is made from"""
+    if index == 0 or index == len(files)-1:
+        radius = 0
+    elif index == 1 or index == len(files)-2:
+        radius = 1
+    else:
+        radius = 2
+    return files[index-radius:index+radius+1]
+
+
+def _runs(indices):
+    """Group sorted `indices` into (start, stop) ranges of consecutive ones"""
+    runs = []
+    for index in indices:
+        if runs and runs[-1][1] == index:
+            runs[-1][1] = index + 1
+        else:
+            runs.append([index, index + 1])
+    return [tuple(run) for run in runs]
+
 
 class SnowProcessing:
-    def __init__(self, terra_files, aqua_files, working_directory, dem_path=None):
+    def __init__(self, terra_files, aqua_files, working_directory,
+                 dem_path=None, block_size=None, elevation_step=5,
+                 workers=1, executor=None, incremental=True,
+                 creation_options=None, cog=False,
+                 overview_resampling='NEAREST', use_vrt=False,
+                 backend=DEFAULT_BACKEND, prefetch=1, write_threads=1,
+                 max_pending_writes=2):
+        """
+        Args:
+            terra_files: List of paths to the classified Terra rasters
+            aqua_files: List of paths to the classified Aqua rasters, in the
+                        same order as `terra_files`
+            working_directory: Directory where the step directories are made
+            dem_path: Path to the DEM. Required by step_3
+            block_size: (xsize, ysize) of the blocks used while streaming
+                        rasters. Defaults to full-width windows of whole
+                        natural blocks of the inputs, of about 4M pixels.
+            elevation_step: Interval, in DEM units, at which step_3 searches
+                            for the snowline
+            workers: Number of processes used for the independent parts of
+                     the steps, and number of chunks step_2 splits the
+                     sequence into. 1 runs everything in this process.
+            executor: A `concurrent.futures.Executor` to run the independent
+                      parts on instead. Takes precedence over `workers`.
+            incremental: If True, outputs recorded in the manifest of the
+                         working directory are only recomputed when their
+                         inputs or parameters have changed. Ignored by
+                         backends that cannot tell rewritten rasters apart.
+            creation_options: GTiff creation options of the outputs; the
+                              name of one of `CREATION_PROFILES` (such as
+                              'deflate') or a list of options. Defaults to
+                              uncompressed rasters.
+            cog: If True, outputs are written as Cloud-Optimized GeoTIFFs
+                 with internal overviews
+            overview_resampling: Resampling of the COG overviews. NEAREST or
+                                 MODE keep the classes of the class maps.
+            use_vrt: If True, the rasters passed through unchanged by step_2
+                     and step_3 are written as VRTs of their inputs instead
+                     of copies, and every step writes a VRT time index
+                     `{step}.vrt` stacking its outputs by date. Not
+                     supported by a `NumpyBackend`.
+            backend: Backend the inputs are read from and the outputs are
+                     written to (see `backends`); e.g. a `NumpyBackend` to
+                     run on scenes already in memory. Only persistent
+                     backends are shared with worker processes, so the
+                     others run in this process.
+            prefetch: Number of scenes step_2 and step_3 read ahead on
+                      background threads while the current one is processed.
+                      0 reads every scene when it is needed.
+            write_threads: Number of threads writing the outputs of a step
+                           in the background while the next scene is
+                           computed. 0 writes every output when it is made.
+            max_pending_writes: Maximum number of outputs queued for
+                                writing; computing the next one waits for
+                                the oldest beyond that. Errors raised while
+                                writing are raised by the step.
+        """
+        if use_vrt and not backend.supports_vrt:
+            raise ValueError(
+                f"use_vrt requires a backend that can build VRTs, not "
+                f"{type(backend).__name__}")
+
         self.working_directory = working_directory
 
         self.terra_files = terra_files
         self.aqua_files = aqua_files
 
         self.dem_path = dem_path
+        self.block_size = block_size
+        self.elevation_step = elevation_step
+        self.workers = workers
+        self.executor = executor
+        self.incremental = incremental
+        self.creation_options = creation_options
+        self.cog = cog
+        self.overview_resampling = overview_resampling
+        self.use_vrt = use_vrt
+        self.backend = backend
+        self.prefetch = prefetch
+        self.write_threads = write_threads
+        self.max_pending_writes = max_pending_writes
+
+        self.manifest = Manifest(working_directory, backend)
+
+    @property
+    def output_options(self):
+        """Entries of the output profiles controlling how they are written"""
+        options = {'creation_options': self.creation_options}
+        if self.cog:
+            options.update(driver='COG',
+                           overview_resampling=self.overview_resampling)
+        return options
+
+    def _is_current(self, output, dependencies):
+        return self.incremental and self.backend.tracks_changes \
+            and self.manifest.is_current(output, dependencies)
+
+    def _map(self, fn, *iterables):
+        """Map `fn` over `iterables` on the configured executor, returning the
+        results in the order of the inputs.
+        """
+        if not self.backend.persistent:
+            return list(map(fn, *iterables))
+        if self.executor is not None:
+            return list(self.executor.map(fn, *iterables))
+        if self.workers > 1:
+            with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                return list(executor.map(fn, *iterables))
+        return list(map(fn, *iterables))
 
     def step_1(self):
         # Check integrity of files
@@ -138,240 +1287,344 @@ class SnowProcessing:
                 f"{len(self.aqua_files)} vs. {len(self.terra_files)}")
 
         savedir = os.path.join(self.working_directory, 'step1')
-        if not os.path.isdir(savedir):
-            os.mkdir(savedir)
+        if not self.backend.isdir(savedir):
+            self.backend.mkdir(savedir)
 
+        stale = []
         for terra_path, aqua_path in zip(self.terra_files, self.aqua_files):
-            terra = Raster(terra_path)
-            aqua = Raster(aqua_path)
-
-            terra_arr = terra.rast.data
-            aqua_arr = aqua.rast.data
-
-            corrected = np.empty(terra_arr.shape)
-            corrected[:] = np.nan
-
-            corrected = np.maximum(terra_arr, aqua_arr)
-
-            profile = terra.profile
-            profile.update(dtype=np.float64)
-
-            result = Raster()
             savepath = os.path.join(
                 savedir,
-                f"{terra.profile['name']}_"
-                f"{aqua.profile['name']}_"
-                f"combined.tif")
-
-            result.array_to_rast(corrected, profile, savepath)
-            result.write()
-            del result
+                f"{_combined_name(terra_path, aqua_path)}.tif")
+            dependencies = self.manifest.dependencies(
+                [terra_path, aqua_path],
+                output=self.output_options)
+            if not self._is_current(savepath, dependencies):
+                stale.append((terra_path, aqua_path, savepath, dependencies))
+        print(f"Step-1: {len(stale)} of {len(self.terra_files)} pairs "
+              f"to process")
+
+        # Every pair is independent, so chunks of pairs can be merged in
+        # parallel
+        bounds = _chunk_bounds(len(stale), self.workers)
+        chunks = [stale[start:stop]
+                  for start, stop in zip(bounds[:-1], bounds[1:])]
+        self._map(_merge_pairs,
+                  [[pair[0] for pair in chunk] for chunk in chunks],
+                  [[pair[1] for pair in chunk] for chunk in chunks],
+                  [[pair[2] for pair in chunk] for chunk in chunks],
+                  itertools.repeat(self.block_size),
+                  itertools.repeat(self.output_options),
+                  itertools.repeat(self.backend),
+                  itertools.repeat(self.write_threads),
+                  itertools.repeat(self.max_pending_writes))
+
+        for _, _, savepath, dependencies in stale:
+            self.manifest.record(savepath, dependencies)
+        self.manifest.save()
+
+        if self.use_vrt:
+            _write_time_index(savedir, self.backend)
 
         return savedir
 
-    def step_2(self):
-        step1_directory = self.step_1()
+    def step_directory(self, step):
+        """Return the directory of the existing outputs of `step` (1, 2 or 3)
+        in the working directory, or None if there are none.
+        """
+        directory = os.path.join(self.working_directory, f"step{step}")
+        if self.backend.isdir(directory) \
+                and _list_rasters(directory, self.backend):
+            return directory
+        return None
+
+    def step_2(self, inputs=None):
+        """
+        Args:
+            inputs: step1 rasters to gap-fill; either a directory or a list
+                    of paths sorted by date. If None, step_1 is run first.
+        """
+        if inputs is None:
+            inputs = self.step_1()
+        files = _as_file_list(inputs, self.backend)
 
-        files = [os.path.join(step1_directory, f)
-                 for f in os.listdir(step1_directory)
-                 if f.endswith('.tif')]
         savedir = os.path.join(self.working_directory, "step2")
-        if not os.path.isdir(savedir):
-            os.mkdir(savedir)
-
-        for current_index in range(0, len(files)):
-            print(f"{current_index} -> {files[current_index]}")
+        if not self.backend.isdir(savedir):
+            self.backend.mkdir(savedir)
+
+        # Only the rasters whose +-2 day neighbourhood has changed are
+        # recomputed
+        stale = []
+        for index in range(len(files)):
+            savepath = _step_2_savepath(savedir, files, index, self.use_vrt)
+            dependencies = self.manifest.dependencies(
+                _step_2_inputs(files, index),
+                output=self.output_options)
+            if not self._is_current(savepath, dependencies):
+                stale.append((index, savepath, dependencies))
+        print(f"Step-2: {len(stale)} of {len(files)} rasters to process")
+
+        # The stale rasters are split into contiguous chunks, each reading the
+        # two rasters on either side of it, so that the chunks are independent
+        starts, stops = [], []
+        for start, stop in _runs([index for index, _, _ in stale]):
+            bounds = _chunk_bounds(stop - start, self.workers)
+            starts.extend(start + bound for bound in bounds[:-1])
+            stops.extend(start + bound for bound in bounds[1:])
+        self._map(_fill_gaps_range,
+                  itertools.repeat(files),
+                  itertools.repeat(savedir),
+                  starts,
+                  stops,
+                  itertools.repeat(self.output_options),
+                  itertools.repeat(self.use_vrt),
+                  itertools.repeat(self.backend),
+                  itertools.repeat(self.prefetch),
+                  itertools.repeat(self.write_threads),
+                  itertools.repeat(self.max_pending_writes))
+
+        for _, savepath, dependencies in stale:
+            self.manifest.record(savepath, dependencies)
+        self.manifest.save()
+
+        if self.use_vrt:
+            _write_time_index(savedir, self.backend)
 
-            if current_index == 0 or current_index == len(files)-1:
-                current = Raster(files[current_index])
-
-                result_arr = current.rast.data
-
-                savepath = os.path.join(
-                    savedir,
-                    f"{current.profile['name']}.tif")
-                print(savepath)
-
-                result = Raster()
-                result.array_to_rast(result_arr, current.profile, savepath)
-                result.write()
-                del result
-            elif current_index == 1 or current_index == len(files)-2:
-                previous = Raster(files[current_index-1])
-                current = Raster(files[current_index])
-                next_ = Raster(files[current_index+1])
-
-                previous_arr = previous.rast.data
-                current_arr = current.rast.data
-                next_arr = next_.rast.data
-
-                result_arr = current_arr.copy()
-
-                snow_condition = ((current_arr == 1) | (current_arr == 0)) \
-                                 & (previous_arr==3) \
-                                 & (next_arr==3)
-                result_arr[snow_condition] = 3
-
-                nosnow_condition = ((current_arr==1) | (current_arr==0)) \
-                                   & (previous_arr==2) \
-                                   & (next_arr==2)
-                result_arr[nosnow_condition] = 2
-
-                savepath = os.path.join(
-                    savedir,
-                    f"{current.profile['name']}.tif")
-
-                result = Raster()
-                result.array_to_rast(result_arr, current.profile, savepath)
-                result.write()
-                del result
-            else:
-                previous_2 = Raster(files[current_index-2])
-                previous = Raster(files[current_index-1])
-                current = Raster(files[current_index])
-                next_ = Raster(files[current_index+1])
-                next_2 = Raster(files[current_index+2])
-
-                previous_2_arr = previous_2.rast.data
-                previous_arr = previous.rast.data
-                current_arr = current.rast.data
-                next_arr = next_.rast.data
-                next_2_arr = next_2.rast.data
-
-                result_arr = current_arr.copy()
-
-                # If Cloud or Nodata in current band, and 3 or 2 in prev and
-                # next, replace current by the prev/next value
-                snow_condition = ((current_arr==1)|(current_arr==0)) \
-                                 & (previous_arr==3) \
-                                 & (next_arr==3)
-                result_arr[snow_condition] = 3
-
-                nosnow_condition = ((current_arr==1)|(current_arr==0)) \
-                                   & (previous_arr==2) \
-                                   & (next_arr==2)
-                result_arr[nosnow_condition] = 2
-
-                # If cloud or nodata in current band, and 3 or2 in prev2 and
-                # next, replace current by theprev/next value
-                snow_condition = ((current_arr==1)|(current_arr==0)) \
-                                 & (previous_2_arr==3) \
-                                 & (next_arr==3)
-                result_arr[snow_condition] = 3
-
-                nosnow_condition = ((current_arr==1)|(current_arr==0)) \
-                                   & (previous_2_arr==2) \
-                                   & (next_arr==2)
-                result_arr[nosnow_condition] = 2
-
-                # If cloud or nodata in current band, and 3 or 2 in prev and
-                # next 2, replace current by theprev/next value
-                snow_condition = ((current_arr==1)|(current_arr==0)) \
-                                 & (previous_arr==3)\
-                                 & (next_2_arr==3)
-                result_arr[snow_condition] = 3
-
-                nosnow_condition = ((current_arr==1)|(current_arr==0)) \
-                                   & (previous_arr==2) \
-                                   & (next_2_arr==2)
-                result_arr[nosnow_condition] = 2
-
-                savepath = os.path.join(
-                    savedir,
-                    f"{current.profile['name']}.tif")
-
-                result = Raster()
-                result.array_to_rast(result_arr, current.profile, savepath)
-                result.write()
-                del result
         return savedir
 
-    def step_3(self):
+    def step_3(self, inputs=None):
+        """
+        Args:
+            inputs: step2 rasters to fill using the snowline; either a
+                    directory or a list of paths. If None, step_2 is run
+                    first.
+        """
         if self.dem_path is None:
             raise NameError("DEM Path not specified")
 
-        step2_dir = self.step_2()
+        if inputs is None:
+            inputs = self.step_2()
+        files = _as_file_list(inputs, self.backend)
 
-        files = [os.path.join(step2_dir, f)
-                 for f in os.listdir(step2_dir)
-                 if f.endswith('.tif')]
         savedir = os.path.join(self.working_directory, "step3")
-        if not os.path.isdir(savedir):
-            os.mkdir(savedir)
-
-        dem_file = Raster(self.dem_path)
-        dem_arr = dem_file.rast.data
-
-        elevations = np.arange(
-            math.floor(dem_arr.min()),
-            math.ceil(dem_arr.max()+1),
-            step=5
-        )
-        reversed_elevations = elevations[::-1]
+        if not self.backend.isdir(savedir):
+            self.backend.mkdir(savedir)
 
+        stale = []
         for file_path in files:
-            # with rasterio.open(file_path) as rst:
-            rst = Raster(file_path)
-            band = rst.rast.data
-
-            # Check if the raster has >70% cloud-free
-            uniques, counts = np.unique(band, return_counts=True)
-            nums = dict(zip(uniques, counts))
-            if 1 not in nums.keys():
-                nums[1] = 0
-            cloud_percentage = (nums[1]/(band.shape[0] * band.shape[
-            1]))*100
-            if cloud_percentage < 70:
-                for i, elevation in enumerate(elevations):
-                    masked_raster = np.where(
-                        dem_arr <= elevation,
-                        band,
-                        np.nan
-                    )
-
-                    if 3 in masked_raster:
-                        # First Snow found; This will be the minimum elevation
-                        # For every cell below this elevation, if there is
-                        # cloud, mark that cell as Non-snow
-
-                        band[(dem_arr <= elevation) & (band == 1)] = 2
-                        break
+            savepath = os.path.join(savedir,
+                                    f"{_raster_name(file_path)}.tif")
+            vrt_path = f"{os.path.splitext(savepath)[0]}.vrt"
+            dependencies = self.manifest.dependencies(
+                [file_path, self.dem_path],
+                elevation_step=self.elevation_step,
+                output=self.output_options)
+            # Whether a scene is skipped is only known once it is read, so
+            # either output may stand for it
+            if not (self._is_current(savepath, dependencies)
+                    or self.use_vrt and self._is_current(vrt_path,
+                                                         dependencies)):
+                stale.append((file_path, savepath, vrt_path, dependencies))
+
+        snowline = None
+        writer = RasterWriter(self.backend)
+        reader = PrefetchReader([file_path for file_path, *_ in stale],
+                                self.prefetch, memmap=True,
+                                backend=self.backend)
+
+        written = []
+        with WriteQueue(self.write_threads, self.max_pending_writes) as queue:
+            for (file_path, savepath, vrt_path, dependencies), rst \
+                    in zip(stale, reader):
+                band = rst.data
+
+                # Check if the raster has >70% cloud-free
+                cloud_percentage = _cloud_percentage(band)
+                if cloud_percentage < 70:
+                    if snowline is None:
+                        snowline = SnowlineIndex.for_dem(self.dem_path,
+                                                         self.elevation_step,
+                                                         self.backend)
+                    snowline.fill(band)
+
+                    print(f"Current File: {rst.profile['name']}.tif -- "
+                          f"Cloud Percentage: {cloud_percentage}")
+
+                    profile = dict(rst.profile, **self.output_options)
+
+                    _remove_vrt(savepath, self.backend)
+                    queue.submit(_write_raster, band, profile, savepath,
+                                 writer)
+                else:
+                    # save the same raster
+                    print(f"Skipped File: {rst.profile['name']}.tif -- "
+                          f"Cloud Percentage: {cloud_percentage}")
+                    if self.use_vrt:
+                        savepath = vrt_path
+                        _write_vrt(savepath, file_path, self.backend)
                     else:
-                        continue
+                        _remove_vrt(savepath, self.backend)
+                        queue.submit(self.backend.copy, file_path, savepath)
 
-                for i, elevation in enumerate(reversed_elevations):
-                    masked_raster = np.where(dem_arr >= elevation,
-                    band, np.nan)
+                written.append((savepath, dependencies))
 
-                    if 2 in masked_raster:
-                        # First Non-Snow found; This will be the maximum
-                        # elevation For every cell above this elevation, if
-                        # there is cloud, mark that cell as snow
+        # Only the outputs written without errors are recorded
+        for savepath, dependencies in written:
+            self.manifest.record(savepath, dependencies)
+        self.manifest.save()
 
-                        band[(dem_arr >= elevation) & (band == 1)] = 3
-                        break
-                    else:
-                        continue
-
-                savepath = os.path.join(
-                    savedir,
-                    f"{rst.profile['name']}.tif")
-                print(f"Current File: {rst.profile['name']}.tif -- "
-                      f"Cloud Percentage: {cloud_percentage}")
-
-                result = Raster()
-                result.array_to_rast(band, rst.profile, savepath)
-                result.write()
-                del result
-            else:
-                # save the same raster
-                savepath = os.path.join(
-                    savedir,
-                    f"{rst.profile['name']}.tif")
-
-                print(f"Skipped File: {rst.profile['name']}.tif -- "
-                      f"Cloud Percentage: {cloud_percentage}")
-                copyfile(file_path, savepath)
+        if self.use_vrt:
+            _write_time_index(savedir, self.backend)
+
+        return savedir
+
+    def run_cube(self, memmap=False, save_intermediate=False):
+        """Run the three steps on a (time, rows, cols) cube of the scenes,
+        instead of writing and reading back a directory of rasters between
+        the steps.
+
+        Args:
+            memmap: If True, the cube is memory-mapped to a temporary file in
+                    the working directory instead of being held in RAM
+            save_intermediate: If True, the step1 and step2 directories are
+                               written as well
+        Returns:
+            savedir: Directory containing the step3 rasters
+        """
+        if self.dem_path is None:
+            raise NameError("DEM Path not specified")
+
+        cube, names, profiles = self._step_1_cube(memmap)
+        if save_intermediate:
+            self._write_cube(cube, names, profiles, "step1")
+
+        self._step_2_cube(cube)
+        if save_intermediate:
+            self._write_cube(cube, names, profiles, "step2")
+
+        self._step_3_cube(cube)
+        return self._write_cube(cube, names, profiles, "step3")
+
+    def _step_1_cube(self, memmap=False):
+        """Merge the Terra/Aqua pairs into a new cube.
+
+        Returns:
+            (cube, names, profiles): The cube, with the scenes in the order
+                                     step_2 reads the step1 directory in, and
+                                     the name and profile of every scene
+        """
+        if len(self.terra_files) != len(self.aqua_files):
+            raise Exception(
+                f"Number of aqua and terra files are not same"
+                f"{len(self.aqua_files)} vs. {len(self.terra_files)}")
+        if not self.terra_files:
+            raise Exception("No Terra/Aqua files to process")
+
+        # Same order as the step1 directory is listed in
+        pairs = sorted(zip(self.terra_files, self.aqua_files),
+                       key=lambda pair: f"{_combined_name(*pair)}.tif")
+        names = [_combined_name(*pair) for pair in pairs]
+
+        first_terra = Raster(pairs[0][0], lazy=True, backend=self.backend)
+        first_aqua = Raster(pairs[0][1], lazy=True, backend=self.backend)
+        shape = (len(pairs),
+                 first_terra.profile['rows'],
+                 first_terra.profile['cols'])
+        dtype = np.result_type(
+            gdal_array.GDALTypeCodeToNumericTypeCode(
+                first_terra.profile['dtype']),
+            gdal_array.GDALTypeCodeToNumericTypeCode(
+                first_aqua.profile['dtype']))
+
+        if memmap:
+            cube = np.memmap(
+                tempfile.TemporaryFile(
+                    dir=self.working_directory
+                    if self.backend.persistent else None),
+                dtype=dtype, mode='w+', shape=shape)
+        else:
+            cube = np.empty(shape, dtype=dtype)
+
+        profiles = []
+        for index, (terra_path, aqua_path) in enumerate(pairs):
+            terra = Raster(terra_path, lazy=True, backend=self.backend)
+            aqua = Raster(aqua_path, lazy=True, backend=self.backend)
+            if terra.profile['shape'] != shape[1:]:
+                raise Exception(
+                    f"Shape of {terra_path} {terra.profile['shape']} differs "
+                    f"from the first scene {shape[1:]}")
+
+            for window, terra_block in terra.blocks(
+                    self.block_size or _stream_block_size(terra.profile)):
+                xoff, yoff, xsize, ysize = window
+                cube[index, yoff:yoff+ysize, xoff:xoff+xsize] = np.maximum(
+                    terra_block, aqua.read_block(window))
+
+            profile = terra.profile
+            profile.update(dtype=gdal.GDT_Byte)
+            profile.update(self.output_options)
+            profiles.append(profile)
+
+        return cube, names, profiles
+
+    def _step_2_cube(self, cube):
+        """Gap-fill the cube in place along the time axis, with the same rules
+        as step_2.
+        """
+        n = len(cube)
+        kernel = GapFillKernel()
+        out = np.empty(cube.shape[1:], dtype=cube.dtype)
+        # Results are written back into the cube, so the original values of
+        # the two previous scenes are kept aside for the scenes after them
+        originals = np.empty((2,) + cube.shape[1:], dtype=cube.dtype)
+
+        for current_index in range(n):
+            print(f"Step-2: scene {current_index + 1}/{n}")
+            if 0 < current_index < n-1:
+                previous_2 = originals[(current_index-2) % 2]
+                next_2 = cube[current_index+2] \
+                    if current_index + 2 < n else None
+                if current_index == 1 or current_index == n-2:
+                    previous_2 = next_2 = None
+
+                kernel(cube[current_index],
+                       originals[(current_index-1) % 2],
+                       cube[current_index+1],
+                       previous_2,
+                       next_2,
+                       out=out)
+
+            originals[current_index % 2] = cube[current_index]
+            if 0 < current_index < n-1:
+                cube[current_index] = out
+
+    def _step_3_cube(self, cube):
+        """Fill the clouds of the cube in place using the snowline, with the
+        same rules as step_3.
+        """
+        snowline = SnowlineIndex.for_dem(self.dem_path, self.elevation_step,
+                                         self.backend)
+
+        for band in cube:
+            cloud_percentage = _cloud_percentage(band)
+            print(f"Cloud Percentage: {cloud_percentage}")
+            if cloud_percentage < 70:
+                snowline.fill(band)
+
+    def _write_cube(self, cube, names, profiles, step):
+        """Write every scene of the cube into the `step` directory"""
+        savedir = os.path.join(self.working_directory, step)
+        if not self.backend.isdir(savedir):
+            self.backend.mkdir(savedir)
+
+        writer = RasterWriter(self.backend)
+        # The cube is not changed while its scenes are written
+        with WriteQueue(self.write_threads, self.max_pending_writes) as queue:
+            for band, name, profile in zip(cube, names, profiles):
+                savepath = os.path.join(savedir, f"{name}.tif")
+                queue.submit(_write_raster, band, profile, savepath, writer)
+
+        if self.use_vrt:
+            _write_time_index(savedir, self.backend)
 
         return savedir
 
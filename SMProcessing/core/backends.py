@@ -0,0 +1,311 @@
+from osgeo import gdal, gdal_array
+import numpy as np
+import itertools
+import os
+from shutil import copyfile
+
+gdal.UseExceptions()
+
+
+class GDALBackend:
+    """Rasters stored as files on disk, read and written by GDAL.
+
+    A backend opens rasters, gives the drivers creating them, and manages the
+    directories they are stored in. Rasters and the processing steps only go
+    through it, so that the same pipeline can run on disk or in memory.
+    """
+    # Whether the rasters outlive the process, and can be shared with worker
+    # processes. Manifests and caches are only kept for persistent backends.
+    persistent = True
+    # Whether `build_vrt` can reference the rasters of the backend
+    supports_vrt = True
+    # Whether `stat` changes whenever a raster is rewritten, so that the
+    # manifest can tell which outputs are current
+    tracks_changes = True
+
+    def open(self, path):
+        return gdal.Open(path)
+
+    def driver(self, name):
+        """The driver `name`, or None if GDAL does not provide it"""
+        return gdal.GetDriverByName(name)
+
+    def exists(self, path):
+        return os.path.exists(path)
+
+    def isdir(self, path):
+        return os.path.isdir(path)
+
+    def listdir(self, path):
+        return os.listdir(path)
+
+    def mkdir(self, path):
+        os.mkdir(path)
+
+    def remove(self, path):
+        os.remove(path)
+
+    def copy(self, source, destination):
+        copyfile(source, destination)
+
+    def stat(self, path):
+        """(size, modification time in ns) of the raster at `path`"""
+        stat = os.stat(path)
+        return stat.st_size, stat.st_mtime_ns
+
+    def build_vrt(self, path, sources, separate=False):
+        """Write a VRT at `path` referencing the rasters `sources`, either as
+        a mosaic or, if `separate`, as one band per source.
+        """
+        vrt = gdal.BuildVRT(path, sources, separate=separate)
+        vrt = None
+
+
+class VSIMemBackend(GDALBackend):
+    """Rasters held in GDAL's in-memory file system. Paths must be under
+    `/vsimem/`, e.g. a working directory of `/vsimem/run`.
+
+    The rasters are still encoded by the GDAL drivers, so this measures the
+    pipeline without the disk, but not without the codecs.
+
+    Its modification times have a resolution of one second, and a class map
+    rewritten within the same second keeps the same size, so runs on it are
+    never incremental.
+    """
+    persistent = False
+    tracks_changes = False
+
+    def exists(self, path):
+        return gdal.VSIStatL(path) is not None
+
+    def isdir(self, path):
+        stat = gdal.VSIStatL(path)
+        return stat is not None and stat.IsDirectory()
+
+    def listdir(self, path):
+        return gdal.ReadDir(path) or []
+
+    def mkdir(self, path):
+        gdal.Mkdir(path, 0o755)
+
+    def remove(self, path):
+        gdal.Unlink(path)
+
+    def copy(self, source, destination):
+        raster = gdal.Open(source)
+        copy = raster.GetDriver().CreateCopy(destination, raster)
+        copy = None
+
+    def stat(self, path):
+        stat = gdal.VSIStatL(path)
+        return stat.size, stat.mtime * 10**9
+
+
+# Stands in for the modification time of the in-memory rasters
+_versions = itertools.count(1)
+
+
+class NumpyBand:
+    """Band of a `NumpyDataset`, with the part of the GDAL band interface
+    used by `Raster`.
+    """
+    def __init__(self, dataset):
+        self._dataset = dataset
+        self._nodata = None
+
+    @property
+    def DataType(self):
+        return gdal_array.NumericTypeCodeToGDALTypeCode(
+            self._dataset.array.dtype)
+
+    def GetNoDataValue(self):
+        return self._nodata
+
+    def SetNoDataValue(self, nodata):
+        self._nodata = nodata
+
+    def GetBlockSize(self):
+        # The whole band is already in memory
+        return [self._dataset.RasterXSize, self._dataset.RasterYSize]
+
+    def GetMetadataItem(self, name, domain=''):
+        return None
+
+    def ReadAsArray(self, xoff=0, yoff=0, win_xsize=None, win_ysize=None):
+        if win_xsize is None:
+            win_xsize = self._dataset.RasterXSize - xoff
+        if win_ysize is None:
+            win_ysize = self._dataset.RasterYSize - yoff
+        return self._dataset.array[yoff:yoff+win_ysize,
+                                   xoff:xoff+win_xsize].copy()
+
+    def WriteArray(self, array, xoff=0, yoff=0):
+        rows, cols = np.shape(array)
+        self._dataset.array[yoff:yoff+rows, xoff:xoff+cols] = array
+        self._dataset.modified = next(_versions)
+
+    def FlushCache(self):
+        pass
+
+
+class NumpyDataset:
+    """Single band raster held in a numpy array, with the part of the GDAL
+    dataset interface used by `Raster`.
+    """
+    def __init__(self, path, array, driver):
+        self.array = array
+        self._path = path
+        self._driver = driver
+        self._geotransform = (0.0, 1.0, 0.0, 0.0, 0.0, -1.0)
+        self._projection = ''
+        self._band = NumpyBand(self)
+        self.modified = next(_versions)
+
+    RasterCount = 1
+
+    @property
+    def RasterXSize(self):
+        return self.array.shape[1]
+
+    @property
+    def RasterYSize(self):
+        return self.array.shape[0]
+
+    def GetRasterBand(self, index):
+        if index != 1:
+            raise RuntimeError(f"Illegal band #{index}")
+        return self._band
+
+    def GetDriver(self):
+        return self._driver
+
+    def GetDescription(self):
+        return self._path
+
+    def GetMetadata(self, domain=''):
+        return {}
+
+    def GetGeoTransform(self):
+        return self._geotransform
+
+    def SetGeoTransform(self, geotransform):
+        self._geotransform = tuple(geotransform)
+
+    def GetProjectionRef(self):
+        return self._projection
+
+    def SetProjection(self, projection):
+        self._projection = projection
+
+    def BuildOverviews(self, resampling='NEAREST', levels=None):
+        pass
+
+    def FlushCache(self):
+        pass
+
+
+class NumpyDriver:
+    """Creates `NumpyDataset`s in a `NumpyBackend`. It stands in for every
+    GDAL driver, whose creation options are ignored.
+    """
+    ShortName = 'MEM'
+
+    def __init__(self, backend):
+        self._backend = backend
+
+    def Create(self, path, cols, rows, bands=1, data_type=gdal.GDT_Byte,
+               options=None):
+        if bands != 1:
+            raise ValueError("Numpy rasters have a single band")
+        dtype = gdal_array.GDALTypeCodeToNumericTypeCode(data_type)
+        dataset = NumpyDataset(path, np.zeros((rows, cols), dtype=dtype),
+                               self)
+        self._backend.datasets[self._backend.key(path)] = dataset
+        return dataset
+
+    def CreateCopy(self, path, source, strict=0, options=None):
+        band = source.GetRasterBand(1)
+        dataset = NumpyDataset(path, band.ReadAsArray(), self)
+        dataset.SetGeoTransform(source.GetGeoTransform())
+        dataset.SetProjection(source.GetProjectionRef())
+        dataset.GetRasterBand(1).SetNoDataValue(band.GetNoDataValue())
+        self._backend.datasets[self._backend.key(path)] = dataset
+        return dataset
+
+    def Delete(self, path):
+        self._backend.remove(path)
+
+
+class NumpyBackend:
+    """Rasters held as numpy arrays, without any encoding or I/O.
+
+    Used to run the pipeline on scenes already in memory, and to test and
+    benchmark the steps without the disk or the GDAL drivers. Arrays are
+    added with `add` and results read back with `array`.
+    """
+    persistent = False
+    # The arrays are not GDAL datasets, which a VRT could reference
+    supports_vrt = False
+    # Every write bumps the version `stat` returns
+    tracks_changes = True
+
+    def __init__(self):
+        self.datasets = dict()
+        self.directories = set()
+
+    @staticmethod
+    def key(path):
+        return os.path.normpath(path)
+
+    def add(self, path, array, geotransform=None, projection='', nodata=None):
+        """Store `array` as the raster at `path`, without copying it"""
+        dataset = NumpyDataset(path, np.asarray(array), self.driver('MEM'))
+        self.datasets[self.key(path)] = dataset
+        if geotransform is not None:
+            dataset.SetGeoTransform(geotransform)
+        dataset.SetProjection(projection)
+        dataset.GetRasterBand(1).SetNoDataValue(nodata)
+        return path
+
+    def array(self, path):
+        """The array of the raster at `path`"""
+        return self.open(path).array
+
+    def open(self, path):
+        if self.key(path) not in self.datasets:
+            raise RuntimeError(
+                f"{path}: No such file or directory")
+        return self.datasets[self.key(path)]
+
+    def driver(self, name):
+        return NumpyDriver(self)
+
+    def exists(self, path):
+        return self.key(path) in self.datasets or self.isdir(path)
+
+    def isdir(self, path):
+        return self.key(path) in self.directories
+
+    def listdir(self, path):
+        if not self.isdir(path):
+            raise FileNotFoundError(f"No such directory: {path}")
+        return [os.path.basename(key)
+                for key in itertools.chain(self.datasets, self.directories)
+                if os.path.dirname(key) == self.key(path)]
+
+    def mkdir(self, path):
+        self.directories.add(self.key(path))
+
+    def remove(self, path):
+        if self.datasets.pop(self.key(path), None) is None:
+            raise FileNotFoundError(f"No such file: {path}")
+
+    def copy(self, source, destination):
+        self.driver('MEM').CreateCopy(destination, self.open(source))
+
+    def stat(self, path):
+        dataset = self.open(path)
+        return dataset.array.nbytes, dataset.modified
+
+
+DEFAULT_BACKEND = GDALBackend()
@@ -0,0 +1,213 @@
+import os
+import sys
+import tempfile
+
+import numpy as np
+from osgeo import gdal, ogr, osr
+from qgis.core import QgsRasterLayer
+from qgis.testing import unittest
+
+from SMProcessing.core.DEMProcessing import (
+    Classifier,
+    DEMProcessing,
+    _block_counts,
+    _jenks_breaks,
+    _quantile_breaks,
+    _stream_histogram,
+    _stream_stats,
+    _stream_uniques,
+    _stream_zonal_stats
+)
+
+
+def as_blocks(dem_arr, rows=7):
+    """Split `dem_arr` into full-width blocks, as `Raster.blocks` does"""
+    cols = dem_arr.shape[1]
+    for yoff in range(0, dem_arr.shape[0], rows):
+        block = dem_arr[yoff:yoff+rows]
+        yield (0, yoff, cols, len(block)), block
+
+
+class TestDEMProcessing(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = np.random.RandomState(47)
+        self.dem_arr = self.rng.randint(1000, 4000, (40, 30)).astype(np.int16)
+        self.dem_arr[:3, :5] = -9999
+
+    def test_stream_stats(self):
+        stats = _stream_stats(as_blocks(self.dem_arr), nodata=-9999)
+
+        valid = self.dem_arr[self.dem_arr != -9999].astype(np.float64)
+        self.assertEqual(stats['COUNT'], valid.size)
+        self.assertEqual(stats['MIN'], valid.min())
+        self.assertEqual(stats['MAX'], valid.max())
+        self.assertAlmostEqual(stats['SUM'], valid.sum())
+        self.assertAlmostEqual(stats['MEAN'], valid.mean())
+        self.assertAlmostEqual(stats['STD_DEV'], valid.std())
+
+    def test_stream_stats_nan(self):
+        dem_arr = self.dem_arr.astype(np.float32)
+        dem_arr[dem_arr == -9999] = np.nan
+
+        stats = _stream_stats(as_blocks(dem_arr))
+        self.assertEqual(stats['COUNT'], np.count_nonzero(~np.isnan(dem_arr)))
+        self.assertAlmostEqual(stats['MEAN'], np.nanmean(dem_arr), places=3)
+
+    def test_stream_uniques(self):
+        values, counts, nodata_count = _stream_uniques(
+            as_blocks(self.dem_arr), nodata=-9999)
+
+        expected_values, expected_counts = np.unique(
+            self.dem_arr[self.dem_arr != -9999], return_counts=True)
+        np.testing.assert_array_equal(values, expected_values)
+        np.testing.assert_array_equal(counts, expected_counts)
+        self.assertEqual(nodata_count, 15)
+
+    def test_stream_uniques_quantized(self):
+        dem_arr = self.dem_arr / 7
+        values, counts, _ = _stream_uniques(
+            as_blocks(dem_arr), nodata=-9999 / 7, decimals=1)
+
+        expected_values, expected_counts = np.unique(
+            np.round(dem_arr[self.dem_arr != -9999], 1), return_counts=True)
+        np.testing.assert_array_equal(values, expected_values)
+        np.testing.assert_array_equal(counts, expected_counts)
+
+    def test_block_counts_wide_range(self):
+        # The range of the block does not fit in its int16 dtype
+        block = self.rng.randint(-20000, 20000, 10000).astype(np.int16)
+        block[:2] = -20000, 20000
+
+        values, counts = _block_counts(block)
+        expected_values, expected_counts = np.unique(block, return_counts=True)
+        np.testing.assert_array_equal(values, expected_values)
+        np.testing.assert_array_equal(counts, expected_counts)
+
+    def test_classifier(self):
+        breaks = [1000, 1500, 2250, 4000]
+        valid = self.dem_arr != -9999
+        expected = np.full(self.dem_arr.shape, 255, dtype=np.uint8)
+        expected[valid & (self.dem_arr < 1500)] = 0
+        expected[valid & (self.dem_arr >= 1500) & (self.dem_arr < 2250)] = 1
+        expected[valid & (self.dem_arr >= 2250)] = 2
+
+        # Both through the lookup table and by searching the breaks
+        for low, high in ((1000, 3999), (None, None)):
+            classifier = Classifier(breaks, -9999, low, high)
+            np.testing.assert_array_equal(classifier(self.dem_arr), expected)
+
+    def test_stream_histogram(self):
+        edges = np.arange(1000, 4001, dtype=np.float64)
+        counts = _stream_histogram(as_blocks(self.dem_arr), edges, -9999)
+
+        expected, _ = np.histogram(self.dem_arr[self.dem_arr != -9999], edges)
+        np.testing.assert_array_equal(counts, expected)
+
+    def test_quantile_breaks(self):
+        edges = np.arange(101, dtype=np.float64)
+        counts = np.ones(100)
+        counts[40:60] = 0
+
+        breaks = _quantile_breaks(edges, counts, 5)
+        np.testing.assert_allclose(breaks, [0, 20, 40, 80, 100])
+
+    def test_jenks_breaks(self):
+        edges = np.arange(31, dtype=np.float64)
+        counts = np.zeros(30)
+        counts[[0, 1, 2, 10, 11, 12, 20, 21, 22]] = [5, 9, 5, 1, 2, 1, 7, 7, 7]
+
+        breaks = _jenks_breaks(edges, counts, 4)
+        np.testing.assert_array_equal(breaks, [0, 10, 20, 30])
+
+    def test_stream_zonal_stats(self):
+        zone_arr = self.rng.randint(-1, 6, self.dem_arr.shape)
+        zone_arr[zone_arr == 3] = -1
+        row_areas = np.linspace(1, 2, self.dem_arr.shape[0])
+        classifier = Classifier([1000, 2000, 3000, 4000], -9999)
+
+        zones, stats, hypsometry = _stream_zonal_stats(
+            as_blocks(self.dem_arr), (block for _, block in
+                                      as_blocks(zone_arr)),
+            -9999, classifier, row_areas, shift=2500)
+
+        np.testing.assert_array_equal(zones, [0, 1, 2, 4, 5])
+        areas = np.broadcast_to(row_areas[:, np.newaxis], zone_arr.shape)
+        bands = classifier(self.dem_arr)
+        for i, zone in enumerate(zones):
+            in_zone = (zone_arr == zone) & (self.dem_arr != -9999)
+            values = self.dem_arr[in_zone]
+            self.assertEqual(stats['count'][i], values.size)
+            self.assertAlmostEqual(stats['area'][i], areas[in_zone].sum())
+            self.assertAlmostEqual(stats['mean'][i], values.mean())
+            self.assertAlmostEqual(stats['std'][i], values.std())
+            self.assertEqual(stats['min'][i], values.min())
+            self.assertEqual(stats['max'][i], values.max())
+            for band in range(3):
+                self.assertAlmostEqual(
+                    hypsometry[i, band],
+                    areas[in_zone & (bands == band)].sum())
+
+
+class TestDEMProcessingGTiff(unittest.TestCase):
+    """DEMProcessing on a GTiff DEM in a temporary directory"""
+
+    def setUp(self):
+        self.rng = np.random.RandomState(47)
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.directory = self.tempdir.name
+
+        self.srs = osr.SpatialReference()
+        self.srs.ImportFromEPSG(32632)
+        self.dem_arr = self.rng.randint(1000, 4000, (40, 30)).astype(np.int16)
+        self.dem_path = os.path.join(self.directory, 'dem.tif')
+        dem = gdal.GetDriverByName('GTiff').Create(
+            self.dem_path, 30, 40, 1, gdal.GDT_Int16)
+        dem.SetGeoTransform((600000.0, 100.0, 0.0, 5200000.0, 0.0, -100.0))
+        dem.SetProjection(self.srs.ExportToWkt())
+        dem.GetRasterBand(1).WriteArray(self.dem_arr)
+        dem = None
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_zonal_stats_large_ids(self):
+        # Basin ids overflowing an Int32 raster, split at column 12
+        zones_path = os.path.join(self.directory, 'zones.gpkg')
+        vector = ogr.GetDriverByName('GPKG').CreateDataSource(zones_path)
+        layer = vector.CreateLayer('zones', self.srs, ogr.wkbPolygon)
+        layer.CreateField(ogr.FieldDefn('basin', ogr.OFTInteger64))
+        for basin, (west, east) in ((9876543210, (601200, 603000)),
+                                    (4000000001, (600000, 601200))):
+            feature = ogr.Feature(layer.GetLayerDefn())
+            feature.SetField('basin', basin)
+            feature.SetGeometry(ogr.CreateGeometryFromWkt(
+                f"POLYGON (({west} 5196000, {east} 5196000, "
+                f"{east} 5200000, {west} 5200000, {west} 5196000))"))
+            layer.CreateFeature(feature)
+        vector = None
+
+        dem = DEMProcessing(QgsRasterLayer(self.dem_path, 'dem'))
+        table, hypsometry = dem.zonal_stats(
+            zones_path, field='basin', breaks=[1000, 2500, 4000])
+
+        self.assertEqual(list(table.index), [4000000001, 9876543210])
+        for basin, columns in ((4000000001, slice(None, 12)),
+                               (9876543210, slice(12, None))):
+            values = self.dem_arr[:, columns]
+            self.assertEqual(table.loc[basin, 'count'], values.size)
+            self.assertAlmostEqual(table.loc[basin, 'area'],
+                                   values.size * 100.0 ** 2)
+            self.assertAlmostEqual(table.loc[basin, 'mean'], values.mean())
+            self.assertEqual(table.loc[basin, 'min'], values.min())
+            self.assertEqual(table.loc[basin, 'max'], values.max())
+            self.assertAlmostEqual(hypsometry.loc[basin].sum(),
+                                   values.size * 100.0 ** 2)
+
+
+def run_all():
+    """Default function that is called by the runner if nothing else is specified"""
+    suite = unittest.TestSuite()
+    suite.addTests(unittest.makeSuite(TestDEMProcessing, 'test'))
+    suite.addTests(unittest.makeSuite(TestDEMProcessingGTiff, 'test'))
+    unittest.TextTestRunner(verbosity=3, stream=sys.stdout).run(suite)
@@ -0,0 +1,595 @@
+import os
+import sys
+import math
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import numpy as np
+import numpy.ma as ma
+from osgeo import gdal, gdal_array, osr
+from qgis.testing import unittest
+
+from SMProcessing.core.SnowProcessing import (
+    CREATION_PROFILES,
+    GapFillKernel,
+    PrefetchReader,
+    Raster,
+    SnowlineIndex,
+    SnowProcessing,
+    WriteQueue,
+    _list_rasters,
+    _raster_name,
+    _stream_block_size
+)
+from SMProcessing.core.backends import NumpyBackend, VSIMemBackend
+
+
+def reference_fill(current, previous, next_, previous_2=None, next_2=None):
+    """The step_2 rules, applied one boolean mask at a time"""
+    result = current.copy()
+    gap = (current == 1) | (current == 0)
+
+    pairs = [(previous, next_)]
+    if previous_2 is not None:
+        pairs += [(previous_2, next_), (previous, next_2)]
+    for before, after in pairs:
+        result[gap & (before == 3) & (after == 3)] = 3
+        result[gap & (before == 2) & (after == 2)] = 2
+
+    return result
+
+
+def reference_snowline(band, dem_arr):
+    """The step_3 snowline search, scanning every elevation in turn"""
+    elevations = np.arange(
+        math.floor(dem_arr.min()), math.ceil(dem_arr.max()+1), step=5)
+
+    for elevation in elevations:
+        if 3 in np.where(dem_arr <= elevation, band, np.nan):
+            band[(dem_arr <= elevation) & (band == 1)] = 2
+            break
+
+    for elevation in elevations[::-1]:
+        if 2 in np.where(dem_arr >= elevation, band, np.nan):
+            band[(dem_arr >= elevation) & (band == 1)] = 3
+            break
+
+
+class TestSnowProcessing(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = np.random.RandomState(47)
+
+    def random_scenes(self, dtype):
+        return [self.rng.randint(0, 5, (40, 30)).astype(dtype)
+                for _ in range(5)]
+
+    def add_pairs(self, backend, count, start=0, projection=''):
+        """Add `count` Terra/Aqua pairs of random scenes to `backend`"""
+        terra_files, aqua_files = [], []
+        for index in range(start, start + count):
+            terra, aqua = self.random_scenes(np.uint8)[:2]
+            name = f"day_{index:02d}.tif"
+            terra_files.append(backend.add(f"terra/{name}", terra,
+                                           projection=projection))
+            aqua_files.append(backend.add(f"aqua/{name}", aqua,
+                                          projection=projection))
+        return terra_files, aqua_files
+
+    def numpy_backend(self):
+        """NumpyBackend holding a DEM, and the directories of a run"""
+        backend = NumpyBackend()
+        for directory in ('terra', 'aqua', 'run'):
+            backend.mkdir(directory)
+        backend.add('dem.tif', self.rng.randint(
+            1000, 1200, (40, 30)).astype(np.int16))
+        return backend
+
+    def step_arrays(self, backend, savedir):
+        """{name: array} of the rasters in the step directory `savedir`"""
+        return {name: backend.array(os.path.join(savedir, name))
+                for name in backend.listdir(savedir)}
+
+    def test_raster_name(self):
+        for path, name in (('terra/day_swift.tif', 'day_swift'),
+                           ('a_t.tif', 'a_t'),
+                           ('a_tt.tif', 'a_tt'),
+                           ('step2/day.vrt', 'day'),
+                           (r'C:\data\day.TIF', 'day'),
+                           ('day.tif.tmp', 'day.tif.tmp')):
+            self.assertEqual(_raster_name(path), name)
+
+    def test_raster_mask(self):
+        backend = NumpyBackend()
+        array = self.rng.randint(0, 5, (40, 30)).astype(np.float32)
+        array[:3] = 255
+        array[-2:] = np.nan
+
+        for nodata, expected in ((None, ma.nomask),
+                                 (255, array == 255),
+                                 (np.nan, np.isnan(array))):
+            raster = Raster(backend.add('scene.tif', array, nodata=nodata),
+                            backend=backend)
+            if nodata is None:
+                self.assertIs(raster.mask, ma.nomask)
+            np.testing.assert_array_equal(raster.mask, expected)
+            np.testing.assert_array_equal(ma.getmask(raster.rast), expected)
+            # The masked array is a view of the band
+            self.assertTrue(np.shares_memory(raster.rast, raster.data))
+            raster.data[5, 5] = 3
+            self.assertEqual(raster.rast[5, 5], 3)
+
+    def test_raster_blocks(self):
+        backend = NumpyBackend()
+        array = self.rng.randint(0, 5, (40, 30)).astype(np.uint8)
+        raster = Raster(backend.add('scene.tif', array), lazy=True,
+                        backend=backend)
+
+        # Neither side of the raster is a multiple of the block size
+        windows = []
+        for (xoff, yoff, xsize, ysize), block in raster.blocks((16, 12)):
+            windows.append((xoff, yoff, xsize, ysize))
+            np.testing.assert_array_equal(
+                block, array[yoff:yoff+ysize, xoff:xoff+xsize])
+        self.assertEqual(windows, [(xoff, yoff, min(16, 30 - xoff),
+                                    min(12, 40 - yoff))
+                                   for yoff in (0, 12, 24, 36)
+                                   for xoff in (0, 16)])
+
+    def test_stream_block_size(self):
+        profile = {'cols': 30, 'rows': 40, 'block_size': (30, 4)}
+        # Whole strips, and at least one of them
+        self.assertEqual(_stream_block_size(profile, pixels=500), (30, 16))
+        self.assertEqual(_stream_block_size(profile, pixels=10), (30, 4))
+        self.assertEqual(_stream_block_size(profile), (30, 40))
+
+    def test_gap_fill_kernel(self):
+        kernel = GapFillKernel()
+        for dtype in (np.uint8, np.int16, np.float64):
+            previous_2, previous, current, next_, next_2 = \
+                self.random_scenes(dtype)
+
+            result = kernel(current, previous, next_, previous_2, next_2)
+            expected = reference_fill(
+                current, previous, next_, previous_2, next_2)
+            self.assertEqual(result.dtype, current.dtype)
+            np.testing.assert_array_equal(result, expected)
+
+    def test_gap_fill_kernel_immediate_neighbours(self):
+        kernel = GapFillKernel()
+        _, previous, current, next_, _ = self.random_scenes(np.uint8)
+
+        result = kernel(current, previous, next_)
+        expected = reference_fill(current, previous, next_)
+        np.testing.assert_array_equal(result, expected)
+
+    def test_snowline_index(self):
+        for dem_dtype in (np.int16, np.float64):
+            dem_arr = self.rng.randint(1000, 1200, (40, 30)).astype(dem_dtype)
+            band = self.rng.choice(
+                4, (40, 30), p=(0.1, 0.5, 0.2, 0.2)).astype(np.uint8)
+
+            expected = band.copy()
+            reference_snowline(expected, dem_arr)
+
+            SnowlineIndex.from_dem(dem_arr).fill(band)
+            np.testing.assert_array_equal(band, expected)
+
+        with self.assertRaises(ValueError):
+            SnowlineIndex.from_dem(dem_arr).fill(band.T.copy())
+
+    def test_prefetch_reader(self):
+        backend = NumpyBackend()
+        scenes = self.random_scenes(np.uint8)
+        paths = [backend.add(f"scene_{index}.tif", scene)
+                 for index, scene in enumerate(scenes)]
+
+        for depth in (0, 1, 3):
+            rasters = PrefetchReader(paths, depth, backend=backend)
+            for raster, scene in zip(rasters, scenes):
+                np.testing.assert_array_equal(raster.data, scene)
+
+            # The scenes before a missing one are still yielded, in order
+            read = []
+            with self.assertRaises(RuntimeError):
+                for raster in PrefetchReader(paths[:2] + ['missing.tif'] +
+                                             paths[2:], depth,
+                                             backend=backend):
+                    read.append(raster.path)
+            self.assertEqual(read, paths[:2])
+
+    def test_write_queue_errors(self):
+        def fail():
+            raise OSError("Disk full")
+
+        for threads in (0, 1):
+            with self.assertRaises(OSError):
+                with WriteQueue(threads) as queue:
+                    queue.submit(fail)
+
+    def test_write_queue_max_pending(self):
+        release = threading.Event()
+        submitted = threading.Event()
+        written = []
+
+        def write(index):
+            release.wait(5)
+            written.append(index)
+
+        def submit_third():
+            queue.submit(write, 2)
+            submitted.set()
+
+        queue = WriteQueue(threads=2, max_pending=2)
+        queue.submit(write, 0)
+        queue.submit(write, 1)
+        # A third write waits until one of the first two is done
+        thread = threading.Thread(target=submit_third)
+        thread.start()
+        self.assertFalse(submitted.wait(0.2))
+        release.set()
+        self.assertTrue(submitted.wait(5))
+        thread.join()
+        queue.close()
+        self.assertEqual(sorted(written), [0, 1, 2])
+
+    def test_write_queue_failed_step(self):
+        written = []
+
+        def write(index):
+            if index == 0:
+                # Still running when the step fails
+                threading.Event().wait(0.5)
+            written.append(index)
+
+        with self.assertRaises(ValueError):
+            with WriteQueue(threads=1, max_pending=3) as queue:
+                for index in range(3):
+                    queue.submit(write, index)
+                raise ValueError("Step failed")
+        # The running write is finished, the queued ones are dropped
+        self.assertEqual(written, [0])
+
+    def test_step_2_numpy_backend(self):
+        scenes = self.random_scenes(np.uint8) + self.random_scenes(np.uint8)
+        # The chunks step_2 splits the sequence into must give the same
+        # result as a single sweep, also with fewer scenes than chunks
+        for n, workers in ((10, 1), (10, 3), (2, 3)):
+            backend = NumpyBackend()
+            backend.mkdir('run')
+            backend.mkdir('step1')
+            for index, scene in enumerate(scenes[:n]):
+                backend.add(f"step1/scene_{index}.tif", scene)
+
+            processor = SnowProcessing([], [], 'run', workers=workers,
+                                       backend=backend)
+            savedir = processor.step_2('step1')
+
+            for index, scene in enumerate(scenes[:n]):
+                if index in (0, n-1):
+                    expected = scene
+                elif index in (1, n-2):
+                    expected = reference_fill(
+                        scene, scenes[index-1], scenes[index+1])
+                else:
+                    expected = reference_fill(
+                        scene, scenes[index-1], scenes[index+1],
+                        scenes[index-2], scenes[index+2])
+                result = backend.array(
+                    os.path.join(savedir, f"scene_{index}.tif"))
+                np.testing.assert_array_equal(result, expected)
+
+        # VRTs cannot reference the arrays of a NumpyBackend
+        with self.assertRaises(ValueError):
+            SnowProcessing([], [], 'run', use_vrt=True, backend=NumpyBackend())
+
+    def test_output_projection(self):
+        utm = osr.SpatialReference()
+        utm.ImportFromEPSG(32632)
+        wgs84 = osr.SpatialReference()
+        wgs84.ImportFromEPSG(4326)
+
+        # The projection of the scenes, or EPSG:4326 if they have none
+        for projection, expected in ((utm.ExportToWkt(), utm.ExportToWkt()),
+                                     ('', wgs84.ExportToWkt())):
+            backend = self.numpy_backend()
+            terra_files, aqua_files = self.add_pairs(
+                backend, 4, projection=projection)
+            SnowProcessing(terra_files, aqua_files, 'run', 'dem.tif',
+                           backend=backend).step_3()
+
+            for step in ('step1', 'step2', 'step3'):
+                for path in _list_rasters(os.path.join('run', step), backend):
+                    self.assertEqual(backend.open(path).GetProjectionRef(),
+                                     expected)
+
+    def test_vsimem_backend_not_incremental(self):
+        # Its one second modification times cannot tell a rewrite apart
+        processor = SnowProcessing([], [], '/vsimem/run',
+                                   backend=VSIMemBackend())
+        savepath = '/vsimem/run/step2/scene.tif'
+        processor.manifest.record(savepath, {'inputs': []})
+        self.assertFalse(processor._is_current(savepath, {'inputs': []}))
+
+    def test_run_cube_numpy_backend(self):
+        for count in (1, 2, 3, 10):
+            backend = self.numpy_backend()
+            terra_files, aqua_files = self.add_pairs(backend, count)
+            backend.mkdir('cube')
+
+            stepwise = SnowProcessing(terra_files, aqua_files, 'run',
+                                      'dem.tif', backend=backend).step_3()
+            cube = SnowProcessing(terra_files, aqua_files, 'cube',
+                                  'dem.tif', backend=backend).run_cube()
+
+            expected = self.step_arrays(backend, stepwise)
+            result = self.step_arrays(backend, cube)
+            self.assertEqual(sorted(result), sorted(expected))
+            self.assertEqual(len(result), count)
+            for name in expected:
+                np.testing.assert_array_equal(result[name], expected[name])
+
+    def test_incremental_append(self):
+        backend = self.numpy_backend()
+        terra_files, aqua_files = self.add_pairs(backend, 8)
+        processor = SnowProcessing(terra_files, aqua_files, 'run', 'dem.tif',
+                                   backend=backend)
+        processor.step_3()
+
+        steps = [os.path.join('run', step)
+                 for step in ('step1', 'step2', 'step3')]
+        versions = {name: backend.stat(name)[1]
+                    for savedir in steps
+                    for name in _list_rasters(savedir, backend)}
+
+        # The manifest of a NumpyBackend lives in the processor, which is
+        # run again with one more day
+        terra, aqua = self.add_pairs(backend, 1, start=8)
+        terra_files.extend(terra)
+        aqua_files.extend(aqua)
+        processor.step_3()
+
+        # Only the new day, and in step_2 and step_3 the two days before it,
+        # whose neighbourhood has grown
+        for savedir, expected in zip(steps, ([8], [6, 7, 8], [6, 7, 8])):
+            names = _list_rasters(savedir, backend)
+            self.assertEqual(len(names), 9)
+            recomputed = [index for index, name in enumerate(names)
+                          if backend.stat(name)[1] != versions.get(name)]
+            self.assertEqual(recomputed, expected)
+
+        backend.mkdir('fresh')
+        fresh = SnowProcessing(terra_files, aqua_files, 'fresh', 'dem.tif',
+                               backend=backend).step_3()
+        expected = self.step_arrays(backend, fresh)
+        result = self.step_arrays(backend, os.path.join('run', 'step3'))
+        self.assertEqual(sorted(result), sorted(expected))
+        for name in expected:
+            np.testing.assert_array_equal(result[name], expected[name])
+
+
+class TestSnowProcessingGTiff(unittest.TestCase):
+    """Rasters and steps on GTiffs in a temporary directory"""
+
+    def setUp(self):
+        self.rng = np.random.RandomState(47)
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.directory = self.tempdir.name
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def write_gtiff(self, name, array, options=(), projection=''):
+        """Write `array` as the GTiff `name` of the temporary directory"""
+        path = os.path.join(self.directory, name)
+        raster = gdal.GetDriverByName('GTiff').Create(
+            path, array.shape[1], array.shape[0], 1,
+            gdal_array.NumericTypeCodeToGDALTypeCode(array.dtype),
+            list(options))
+        raster.SetGeoTransform((600000.0, 500.0, 0.0, 5200000.0, 0.0, -500.0))
+        raster.SetProjection(projection)
+        raster.GetRasterBand(1).WriteArray(array)
+        raster = None
+        return path
+
+    def read_rasters(self, directory):
+        """{name: bytes} of the GTiffs in `directory`"""
+        rasters = dict()
+        for name in os.listdir(directory):
+            if name.endswith('.tif'):
+                with open(os.path.join(directory, name), 'rb') as f:
+                    rasters[name] = f.read()
+        return rasters
+
+    def add_pairs(self, count):
+        """Write `count` Terra/Aqua pairs of random scenes"""
+        terra_files, aqua_files = [], []
+        for index in range(count):
+            for sensor, files in (('terra', terra_files),
+                                  ('aqua', aqua_files)):
+                scene = self.rng.randint(0, 5, (40, 30)).astype(np.uint8)
+                files.append(
+                    self.write_gtiff(f"{sensor}_{index:02d}.tif", scene))
+        return terra_files, aqua_files
+
+    def test_memmap_strips(self):
+        # (dtype, rows, rows per strip): a single strip, several strips, and
+        # a last strip shorter than the others
+        for dtype, rows, strip_rows in ((np.uint8, 40, 40),
+                                        (np.uint8, 40, 8),
+                                        (np.uint8, 37, 8),
+                                        (np.int16, 37, 8),
+                                        (np.float32, 40, 16)):
+            array = self.rng.randint(-100, 100, (rows, 30)).astype(dtype)
+            path = self.write_gtiff(
+                f"{np.dtype(dtype).name}_{rows}_{strip_rows}.tif", array,
+                [f'BLOCKYSIZE={strip_rows}'])
+
+            raster = Raster(path, memmap=True)
+            self.assertIsInstance(raster.data, np.memmap)
+            self.assertEqual(raster.data.dtype, np.dtype(dtype))
+            np.testing.assert_array_equal(
+                raster.data, gdal.Open(path).ReadAsArray())
+            del raster
+
+    def test_memmap_fallback(self):
+        array = self.rng.randint(0, 5, (40, 30)).astype(np.int16)
+        for name, options in (
+                ('tiled', ['TILED=YES', 'BLOCKXSIZE=16', 'BLOCKYSIZE=16']),
+                ('deflate', ['COMPRESS=DEFLATE']),
+                ('inverted', ['ENDIANNESS=INVERTED'])):
+            path = self.write_gtiff(f"{name}.tif", array, options)
+
+            raster = Raster(path, memmap=True)
+            self.assertNotIsInstance(raster.data, np.memmap)
+            np.testing.assert_array_equal(raster.data, array)
+
+    def test_cog_overviews(self):
+        # A checkerboard of no-snow and snow, whose average is 2
+        rows, cols = np.indices((1024, 1024))
+        array = (1 + 2 * ((rows + cols) % 2)).astype(np.uint8)
+        source = self.write_gtiff('source.tif', array)
+
+        for resampling in ('NEAREST', 'AVERAGE'):
+            path = os.path.join(self.directory, f"{resampling}.tif")
+            profile = dict(Raster(source, lazy=True).profile,
+                           driver='COG',
+                           overview_resampling=resampling,
+                           creation_options=CREATION_PROFILES['deflate'])
+            raster = Raster()
+            raster.array_to_rast(array, profile, path)
+            raster.write()
+            del raster
+
+            cog = gdal.Open(path)
+            self.assertEqual(
+                cog.GetMetadata('IMAGE_STRUCTURE').get('COMPRESSION'),
+                'DEFLATE')
+            band = cog.GetRasterBand(1)
+            np.testing.assert_array_equal(band.ReadAsArray(), array)
+            # The overviews are internal, and resampled as requested
+            self.assertGreater(band.GetOverviewCount(), 0)
+            self.assertFalse(os.path.exists(f"{path}.ovr"))
+            overview = np.unique(band.GetOverview(0).ReadAsArray())
+            if resampling == 'NEAREST':
+                self.assertTrue(set(overview) <= {1, 3})
+            else:
+                self.assertIn(2, overview)
+            del band, cog
+
+        # No scratch raster is left next to the outputs
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         ['AVERAGE.tif', 'NEAREST.tif', 'source.tif'])
+
+    def test_parallel_steps(self):
+        terra_files, aqua_files = self.add_pairs(7)
+
+        runs = {'serial': dict(), 'workers': dict(workers=2)}
+        with ThreadPoolExecutor(2) as executor:
+            runs['executor'] = dict(executor=executor)
+            for run, options in runs.items():
+                working_directory = os.path.join(self.directory, run)
+                os.mkdir(working_directory)
+                SnowProcessing(terra_files, aqua_files, working_directory,
+                               **options).step_2()
+
+        for step in ('step1', 'step2'):
+            expected = self.read_rasters(
+                os.path.join(self.directory, 'serial', step))
+            self.assertEqual(len(expected), 7)
+            for run in ('workers', 'executor'):
+                self.assertEqual(
+                    self.read_rasters(os.path.join(self.directory, run, step)),
+                    expected)
+
+    def test_snowline_index_cache(self):
+        dem_arr = self.rng.randint(1000, 1200, (40, 30)).astype(np.int16)
+        dem_path = self.write_gtiff('dem.tif', dem_arr)
+        cache_path = f"{dem_path}.snowline_5m.npz"
+
+        def for_dem(step=5):
+            """The index of the DEM, and whether the DEM was read"""
+            with mock.patch('SMProcessing.core.SnowProcessing.Raster',
+                            wraps=Raster) as raster:
+                index = SnowlineIndex.for_dem(dem_path, step)
+            expected = SnowlineIndex.from_dem(dem_arr, step)
+            for name in ('order', 'upper', 'lower'):
+                np.testing.assert_array_equal(getattr(index, name),
+                                              getattr(expected, name))
+            self.assertEqual(index.shape, expected.shape)
+            return raster.called
+
+        self.assertTrue(for_dem())
+        self.assertTrue(os.path.isfile(cache_path))
+        self.assertFalse(for_dem())
+
+        # Another step, or a DEM modified since, rebuild the index
+        self.assertTrue(for_dem(step=10))
+        mtime = os.path.getmtime(dem_path) + 10
+        os.utime(dem_path, (mtime, mtime))
+        self.assertTrue(for_dem())
+        self.assertFalse(for_dem())
+
+        # A truncated or corrupt cache is ignored, and written again
+        with open(cache_path, 'rb') as f:
+            cached = f.read()
+        for content in (cached[:len(cached) // 2], b'not an index'):
+            with open(cache_path, 'wb') as f:
+                f.write(content)
+            self.assertTrue(for_dem())
+            self.assertFalse(for_dem())
+
+    def test_vrt_outputs(self):
+        terra_files, aqua_files = self.add_pairs(5)
+        # The first day is all cloud, so it is passed through by step_2, as
+        # the first of the sequence, and by step_3
+        clouds = np.ones((40, 30), dtype=np.uint8)
+        for path in (terra_files[0], aqua_files[0]):
+            self.write_gtiff(os.path.basename(path), clouds)
+        dem_path = self.write_gtiff(
+            'dem.tif', self.rng.randint(1000, 1200, (40, 30)).astype(np.int16))
+        working_directory = os.path.join(self.directory, 'run')
+        os.mkdir(working_directory)
+
+        SnowProcessing(terra_files, aqua_files, working_directory, dem_path,
+                       use_vrt=True).step_3()
+
+        def read(path):
+            return gdal.Open(path).ReadAsArray()
+
+        files = {step: _list_rasters(os.path.join(working_directory, step))
+                 for step in ('step1', 'step2', 'step3')}
+        extensions = {step: [os.path.splitext(path)[1] for path in paths]
+                      for step, paths in files.items()}
+        self.assertEqual(extensions['step2'],
+                         ['.vrt', '.tif', '.tif', '.tif', '.vrt'])
+        self.assertEqual(extensions['step3'],
+                         ['.vrt', '.tif', '.tif', '.tif', '.tif'])
+
+        np.testing.assert_array_equal(read(files['step3'][0]), clouds)
+        np.testing.assert_array_equal(read(files['step2'][-1]),
+                                      read(files['step1'][-1]))
+        # step_3 only fills clouds
+        for step2_path, step3_path in zip(files['step2'], files['step3']):
+            before, after = read(step2_path), read(step3_path)
+            changed = before != after
+            self.assertTrue(np.all(before[changed] == 1))
+            self.assertTrue(np.all(np.isin(after[changed], (2, 3))))
+
+        # One band per date in the time index of every step
+        for step, paths in files.items():
+            index = gdal.Open(os.path.join(working_directory, f"{step}.vrt"))
+            self.assertEqual(index.RasterCount, len(paths))
+            for band, path in enumerate(paths, start=1):
+                np.testing.assert_array_equal(
+                    index.GetRasterBand(band).ReadAsArray(), read(path))
+
+
+def run_all():
+    """Default function that is called by the runner if nothing else is specified"""
+    suite = unittest.TestSuite()
+    suite.addTests(unittest.makeSuite(TestSnowProcessing, 'test'))
+    suite.addTests(unittest.makeSuite(TestSnowProcessingGTiff, 'test'))
+    unittest.TextTestRunner(verbosity=3, stream=sys.stdout).run(suite)